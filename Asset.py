@@ -1,13 +1,23 @@
 import os, sys
 import datetime
+import copy
+import threading
+from collections import OrderedDict
 from glob import glob
+from xml.etree import ElementTree
 import numpy as np
 
 if 'GDAL_DATA' not in os.environ:
     os.environ['GDAL_DATA'] = r'/usr/lib/anaconda/share/gdal'
-from osgeo import gdal, ogr, osr, gdalconst
+from osgeo import gdal, ogr, osr, gdalconst, gdal_array
 import json, yaml
 
+# rtree is optional; without it, source footprints are searched with numpy
+try:
+    from rtree import index as rtree
+except ImportError:
+    rtree = None
+
 RESAMPLE_METHODS = {'average': gdalconst.GRIORA_Average,
                     'bilinear': gdalconst.GRIORA_Bilinear,
                     'cubic': gdalconst.GRIORA_Cubic,
@@ -18,8 +28,20 @@ RESAMPLE_METHODS = {'average': gdalconst.GRIORA_Average,
                     'nearest': gdalconst.GRIORA_NearestNeighbour
                 }
 
+
+VRT_SOURCES = ('SimpleSource', 'ComplexSource', 'AveragedSource', 'KernelFilteredSource')
+
         
 DATA_PATH = '/data/maps/'
+
+# Maximum number of opened assets kept in the process-wide pool
+ASSET_POOL_SIZE = 64
+
+# Maximum number of warped copies (SRS and resample method pairs) kept per asset
+WARP_CACHE_SIZE = 8
+
+# Bands read at a time when windows and regions are streamed
+BAND_BLOCK_SIZE = 16
     
 def ListAssets():
     
@@ -39,26 +61,107 @@ def ListAssets():
         
     return getList(DATA_PATH)
 
+
+def assetFiles(name):
+    # The (virtual) raster file of an asset, followed by each metadata file
+    # that may be merged into it, in the order they are applied.
+    tree = name.split('.')
+    if len(tree) == 1:
+        tree.append('default')
+    files = [os.path.join(DATA_PATH, *tree) + '.vrt']
+    for i in range(len(tree)):
+        for f in  ['.yaml', '/default.yaml', '/'+tree[i]+'.yaml']:
+            files.append(os.path.join(DATA_PATH, *tree[:i+1]) + f)
+    return files
+    
+    
+def modifiedTimes(files):
+    # Modification time of each file, None for those that don't exist
+    times = []
+    for fn in files:
+        try:
+            times.append(os.path.getmtime(fn))
+        except OSError:
+            times.append(None)
+    return tuple(times)
+    
+
+def windowOffsets(transform, bounds):
+    # Raster-space (xoff, yoff, xcount, ycount) of bounds given in the raster's projection
+    xOrigin, pixelWidth, xSkew, yOrigin, ySkew, pixelHeight = transform
+    
+    # Figure out where the Upper Left corner is
+    xmin, ymin, xmax, ymax = bounds
+    ULx = xmin if pixelWidth>0 else xmax
+    ULy = ymin if pixelHeight>0 else ymax
+    
+    # Get the region to read
+    xoff = ((ULx - xOrigin)/pixelWidth)
+    yoff = ((ULy - yOrigin)/pixelHeight)
+    xcount = ((xmax - xmin)/abs(pixelWidth))
+    ycount = ((ymax - ymin)/abs(pixelHeight))
+    
+    return xoff, yoff, xcount, ycount
     
     
+def transformBounds(bounds, sourceSR, targetSR):
+    # Reproject bounds (xmin, ymin, xmax, ymax). The edges are densified, so the
+    # result still covers the original area when the reprojection curves them.
+    return reprojectBounds(bounds, osr.CoordinateTransformation(sourceSR, targetSR))
     
-class Asset:    
+    
+def reprojectBounds(bounds, transform):
+    # transformBounds, through an existing osr.CoordinateTransformation
+    xmin, ymin, xmax, ymax = bounds
+    X = np.linspace(xmin, xmax, 21)
+    Y = np.linspace(ymin, ymax, 21)
+    points = ([(x, Y[0]) for x in X] + [(x, Y[-1]) for x in X] +
+              [(X[0], y) for y in Y] + [(X[-1], y) for y in Y])
+    points = transform.TransformPoints(points)
+    
+    points = np.array(points)[:,:2]
+    xmin, ymin = np.min(points, axis=0)
+    xmax, ymax = np.max(points, axis=0)
+    return (xmin, ymin, xmax, ymax)
+    
+    
+def nodataMask(data, nodata):
+    # Mask of where a (bands, y, x) stack equals each band's nodata value,
+    # given one value (or None) per band
+    if all(v is None for v in nodata):
+        return np.zeros(data.shape, np.bool)
+    if all(v == nodata[0] for v in nodata):
+        return np.equal(data, nodata[0])
+    
+    nodata = np.array([np.nan if v is None else v for v in nodata]).reshape((-1,1,1))
+    return np.equal(data, nodata)
+
+    
+    
+    
+class Asset(object):
     def __init__(self, name):
         self.name = name
-        self.ds = ''
         self.path = ''
+        self.source = ''
         self.metadata = {}
+        self._local = threading.local()
+        self._warped = OrderedDict()
+        self._warpLock = threading.Lock()
+        self._extents = {}
+        self._overviews = None
         
-        # Identify the underlying (virtual) file
-        tree = name.split('.')
-        if len(tree) == 1:
-            tree.append('default')
-        fn = os.path.join(DATA_PATH, *tree) + '.vrt'
+        # Lazily computed values that warped copies share with the asset
+        self.cache = {}
+        
+        # Identify the underlying (virtual) file, and the metadata files along its path
+        self.files = assetFiles(name)
+        fn = self.files[0]
          
         # If found, get metadata, if any, from along path
         if os.path.exists(fn):
             self.path = fn
-            self.ds = gdal.Open(fn)
+            self.source = fn
             t = self.ds.GetGeoTransform()
             self.metadata['native-resolution'] = [t[1] , t[5]]
             self.metadata['native-UL'] = [t[0], t[3]]
@@ -67,15 +170,41 @@ class Asset:
             if 'nodata' not in self.metadata:
                 self.metadata['nodata'] = None
             
-            for i in range(len(tree)):
-                for f in  ['.yaml', '/default.yaml', '/'+tree[i]+'.yaml']:
-                    fn = os.path.join(DATA_PATH, *tree[:i+1]) + f
-                    if os.path.exists(fn):
-                        with open(fn, 'r') as m:
-                            self.metadata.update(yaml.safe_load(m))
+            for fn in self.files[1:]:
+                if os.path.exists(fn):
+                    with open(fn, 'r') as m:
+                        self.metadata.update(yaml.safe_load(m))
 
             self.bandDates = self.metadata['band-dates']
 
+    def getDataset(self, level=None):
+        # GDAL datasets can't be shared between threads, so each thread opens its
+        # own handles on the asset's source, or one of its overview levels, on first use.
+        handles = getattr(self._local, 'handles', None)
+        if handles is None:
+            handles = self._local.handles = {}
+        if level not in handles:
+            if not self.source:
+                handles[level] = ''
+            elif level is None:
+                handles[level] = gdal.Open(self.source)
+            else:
+                handles[level] = gdal.OpenEx(self.source, gdal.OF_RASTER, open_options=['OVERVIEW_LEVEL=%d' % level])
+        return handles[level]
+        
+    @property
+    def ds(self):
+        return self.getDataset()
+        
+    def _derive(self, source):
+        # A copy of this asset, sharing its metadata, backed by a different source
+        asset = copy.copy(self)
+        asset.source = source
+        asset._local = threading.local()
+        asset._warped = OrderedDict()
+        asset._extents = {}
+        asset._overviews = None
+        return asset
         
     def getResampleMethod(self, name):
         try:
@@ -94,15 +223,126 @@ class Asset:
                 return fn
         return ''
         
+        
+    def getOverviewLevel(self, factor):
+        # Index of the coarsest overview whose pixels span at most `factor` full
+        # resolution pixels, or None if the full resolution should be read.
+        if self._overviews is None:
+            band = self.ds.GetRasterBand(1)
+            self._overviews = [float(self.ds.RasterXSize) / band.GetOverview(i).XSize
+                                for i in range(band.GetOverviewCount())]
+        
+        level = None
+        best = 1.0
+        for i, f in enumerate(self._overviews):
+            # Allow for overview sizes having been rounded
+            if best < f <= factor*1.01:
+                level, best = i, f
+        return level
+        
+        
+    def getExtent(self, srs=None):
+        # Bounds (xmin, ymin, xmax, ymax) of the asset, optionally reprojected to
+        # another spatial reference.
+        key = srs.ExportToWkt() if srs is not None else None
+        if key in self._extents:
+            return self._extents[key]
+        
+        xOrigin, pixelWidth, xSkew, yOrigin, ySkew, pixelHeight = self.ds.GetGeoTransform()
+        X = (xOrigin, xOrigin + pixelWidth*self.ds.RasterXSize)
+        Y = (yOrigin, yOrigin + pixelHeight*self.ds.RasterYSize)
+        bounds = (min(X), min(Y), max(X), max(Y))
+        
+        if srs is not None:
+            bounds = transformBounds(bounds, self.getSpatialReference(), srs)
+        
+        self._extents[key] = bounds
+        return bounds
+        
+        
+    def getSpatialReference(self, wkt=None):
+        SR = osr.SpatialReference()
+        SR.ImportFromWkt(wkt or self.ds.GetProjectionRef())
+        return SR
+        
+        
+    def getSourceIndex(self):
+        # Index of the footprints of the sources in the asset's VRT, shared with its
+        # warped copies. None if the VRT has no source footprints to go by.
+        if 'sources' not in self.cache:
+            self.cache['sources'] = SourceIndex.fromVRT(self.path)
+        return self.cache['sources']
+        
+        
+    def windowHasData(self, bounds):
+        # Whether a window, in this asset's projection, touches any source of the VRT.
+        # Windows that don't can be answered without reading anything.
+        index = self.getSourceIndex()
+        if index is None:
+            return True
+        
+        nativeWKT = self.metadata['native-projection']
+        if self.ds.GetProjectionRef() != nativeWKT:
+            # Windows that can't be mapped onto the sources, e.g. reaching past
+            # the edge of their projection, might still touch them, so leave
+            # those to GDAL. Failed points raise, or without exceptions
+            # enabled, come back as infinities.
+            try:
+                bounds = reprojectBounds(bounds, self.getNativeTransform())
+            except RuntimeError:
+                return True
+            if not np.all(np.isfinite(bounds)):
+                return True
+        return index.intersects(bounds)
+        
+        
+    def getNativeTransform(self):
+        # Transformation from this (warped) asset's projection to the native one
+        # of its sources. Transformations can't be shared between threads, so
+        # each thread makes its own on first use.
+        transform = getattr(self._local, 'toNative', None)
+        if transform is None:
+            nativeSR = self.getSpatialReference(self.metadata['native-projection'])
+            transform = osr.CoordinateTransformation(self.getSpatialReference(), nativeSR)
+            self._local.toNative = transform
+        return transform
+        
+        
+    def emptyWindow(self, bands, size):
+        # A fully masked window, in the asset's data type
+        dtype = gdal_array.GDALTypeCodeToNumericTypeCode(self.ds.GetRasterBand(1).DataType)
+        return np.ma.masked_all((len(bands), size[1], size[0]), dtype)
+        
     
     def warpTo(self, srs, resampleMethod):
         resampleMethod = self.getResampleMethod(resampleMethod)
         
+        ## The warped VRT only depends on the target SRS and the resample method,
+        ## so reuse a previously warped copy when there is one
+        key = (srs.ExportToWkt(), resampleMethod)
+        with self._warpLock:
+            warped = self._warped.pop(key, None)
+            if warped is not None:
+                self._warped[key] = warped
+                return warped
+        
+        ## Use the new VRT XML as the dataset of a warped copy, leaving this
+        ## (possibly pooled) asset untouched
+        warped = self._derive(self.getWarpedXML(*key))
+        with self._warpLock:
+            self._warped[key] = warped
+            while len(self._warped) > WARP_CACHE_SIZE:
+                self._warped.popitem(last=False)
+        
+        return warped
+        
+        
+    def getWarpedXML(self, wkt, resampleMethod):
         ## Get the auto-generated warped VRT. It'll need some work.
-        tmp_ds = gdal.AutoCreateWarpedVRT(self.ds, None, srs.ExportToWkt(), resampleMethod)
+        tmp_ds = gdal.AutoCreateWarpedVRT(self.ds, None, wkt, resampleMethod)
         
         ## Read the XML text of the warped VRT
-        memfilename = '/vsimem/tmp_'+str(id(self))+'_'+str(id(srs))+'.vrt'
+        memfilename = '/vsimem/tmp_'+str(id(self))+'_'+str(id(tmp_ds))+'.vrt'
         driver = gdal.GetDriverByName('VRT')
         driver.CreateCopy(memfilename, tmp_ds)
         filehandle = gdal.VSIFOpenL(memfilename, 'r')
@@ -130,10 +370,7 @@ class Asset:
             nd = self.ds.GetRasterBand(b).GetNoDataValue()
             XML = XML.replace(VRT_BAND_WARPED.format(src=b, dst=b), VRT_BAND_NODATA_TEMPLATE.format(src=b, dst=b,nd=nd))
        
-        ## Set the new VRT XML as the current dataset
-        self.ds = gdal.Open(XML);
-            
-        return self
+        return XML
             
             
     def parseBands(self, date):
@@ -146,63 +383,118 @@ class Asset:
         return bands
         
     
+    def selectBands(self, dates=None):
+        # Bands for a comma separated list of dates, each picking its nearest band,
+        # of date ranges as 'first..last', each picking every band between them,
+        # or of band numbers as 'b<n>', e.g. the three bands of an RGB composite.
+        # 'all', or no dates, picks every band.
+        if not isinstance(dates, basestring):
+            return self.datesToBands(dates)
+        
+        bands = []
+        for d in dates.split(','):
+            d = d.strip()
+            if d[:1] == 'b':
+                bands.append(int(d[1:]))
+            elif d.lower() == 'all':
+                bands += self.datesToBands()
+            else:
+                bands += self.datesToBands(d)
+        return bands
+        
+    
     def datesToBands(self, dates=None):
-    # Select bands corresponding to the specified dates
+        # Select bands corresponding to the specified dates: every band, in date
+        # order, for None; every band in a range 'first..last', whose ends are
+        # inclusive and may be left open; or the band nearest a single date
         if dates is None:
-            return self.bandDates.keys().sort()
-
-        dates = [yaml.safe_load(dates)]
-        bands = []
-        if len(dates) == 1:
-            distance = datetime.date.max - datetime.date.min
-            for b in self.bandDates:
-                d = np.abs(self.bandDates[b] - dates[0])
-                if d < distance:
-                    bands = [b]
-                    distance = d
-        else:
-            for b in self.bandDates:
-                if self.bandDates[b] >= dates[0] and self.bandDates[b] <= dates[1]:
-                    bands.append(b)
+            return sorted(self.bandDates, key=lambda b: (self.bandDates[b], b))
         
+        if not isinstance(dates, basestring):
+            # A date already parsed, e.g. from a YAML request
+            dates = str(dates)
+        if '..' in dates:
+            first, last = [yaml.safe_load(d) if d.strip() else None for d in dates.split('..', 1)]
+            return [b for b in self.datesToBands()
+                        if (first is None or self.bandDates[b] >= first) and
+                           (last is None or self.bandDates[b] <= last)]
+        
+        date = yaml.safe_load(dates)
+        bands = []
+        distance = datetime.date.max - datetime.date.min
+        for b in sorted(self.bandDates):
+            d = abs(self.bandDates[b] - date)
+            if d < distance:
+                bands = [b]
+                distance = d
         return bands
     
     
     
+    def getBandDates(self, bands):
+        # The date of each band, None for bands without one
+        return [self.bandDates.get(b) for b in bands]
+        
+        
     def getWindow(self, bounds, dates, size, resampleMethod=None):
-        resampleMethod = self.getResampleMethod(resampleMethod)
-        bands = self.datesToBands(dates)
+        return self.readWindow(bounds, self.selectBands(dates), size, resampleMethod)
         
-        xOrigin, pixelWidth, xSkew, yOrigin, ySkew, pixelHeight = self.ds.GetGeoTransform()
         
-        # Figure out where the Upper Left corner is
-        xmin, ymin, xmax, ymax = bounds
-        ULx = xmin if pixelWidth>0 else xmax
-        ULy = ymin if pixelHeight>0 else ymax
+    def iterWindow(self, bounds, dates, size, resampleMethod=None, blockSize=BAND_BLOCK_SIZE):
+        # getWindow, read and yielded a block of bands at a time
+        bands = self.selectBands(dates)
+        for i in range(0, len(bands), blockSize):
+            yield self.readWindow(bounds, bands[i:i+blockSize], size, resampleMethod)
         
-        # Get the region to read
-        xoff = ((ULx - xOrigin)/pixelWidth)
-        yoff = ((ULy - yOrigin)/pixelHeight)
-        xcount = ((xmax - xmin)/abs(pixelWidth))
-        ycount = ((ymax - ymin)/abs(pixelHeight))
         
-        data = np.zeros((len(bands), size[0], size[1]))
-        mask = np.zeros((len(bands), size[0], size[1]), np.bool)
-        nd = self.metadata['nodata']
-        for i, b in enumerate(bands):
-            band = self.ds.GetRasterBand(b)
-            d = band.ReadAsArray(xoff, yoff, xcount, ycount, size[0], size[1], resample_alg=resampleMethod)
-            mask[i,:,:] = np.equal(d, band.GetNoDataValue()) #+ np.equal(d,nd)
-            data[i,:,:] = d
-        data = np.ma.MaskedArray(data, mask)
+    def readWindow(self, bounds, bands, size, resampleMethod=None):
+        resampleMethod = self.getResampleMethod(resampleMethod)
+        
+        # Don't touch GDAL for windows that fall outside all of the asset's sources
+        if not self.windowHasData(bounds):
+            return self.emptyWindow(bands, size)
+        
+        # Read from the coarsest overview that still has the requested resolution
+        xoff, yoff, xcount, ycount = windowOffsets(self.ds.GetGeoTransform(), bounds)
+        level = self.getOverviewLevel(xcount/size[0])
+        ds = self.getDataset(level)
+        if level is not None:
+            xoff, yoff, xcount, ycount = windowOffsets(ds.GetGeoTransform(), bounds)
         
-        return data
+        # Read all the bands at once, in their native data type
+        data = ds.ReadAsArray(xoff, yoff, xcount, ycount, buf_xsize=size[0], buf_ysize=size[1],
+                              band_list=list(bands), resample_alg=resampleMethod)
+        data = data.reshape((len(bands), size[1], size[0]))
+        mask = nodataMask(data, [ds.GetRasterBand(b).GetNoDataValue() for b in bands])
+        
+        return np.ma.MaskedArray(data, mask)
         
 
     def getRegion(self, region, dates=None, resampleMethod=None):
-    
-        resampleMethod = self.getResampleMethod(resampleMethod)
-        bands = self.datesToBands(dates)
+        offsets, weights = self.regionOffsets(region)
+        data = self.readRegion(offsets, self.regionBands(dates))
+        return data, weights
+        
+        
+    def iterRegion(self, region, dates=None, resampleMethod=None, blockSize=BAND_BLOCK_SIZE):
+        # getRegion, with the data read a block of bands at a time as it's iterated
+        offsets, weights = self.regionOffsets(region)
+        bands = self.regionBands(dates)
+        blocks = (self.readRegion(offsets, bands[i:i+blockSize]) for i in range(0, len(bands), blockSize))
+        return blocks, weights
+        
+        
+    def regionBands(self, dates=None):
+        # if bands isn't specified, read data in all of them
+        bands = self.selectBands(dates)
+        if not bands:
+            bands = range(1,self.ds.RasterCount+1)
+        return list(bands)
+        
+        
+    def regionOffsets(self, region):
+        # The (xoff, yoff, xcount, ycount) raster window covering a region, and
+        # the weights of its pixels (None for a point)
         
         # Determine if need to grab just a single pixel or a region
         isPoint = (region.geom.GetGeometryName() == 'POINT')
@@ -211,30 +503,30 @@ class Asset:
             # Grab just the single pixel covering the Point
             xoff, yoff = self.getRasterOffset(region)
             xcount, ycount = (1,1)
+            weights = None
         else:
             # Get mask of region in raster-space
             proj = self.ds.GetProjectionRef()
             transform =  self.ds.GetGeoTransform()
             weights, offsets = region.rasterize(proj, transform, 1)
             xoff, yoff = offsets
-            ycount, xcount = mask.shape
-            
-        # if bands isn't specified, read data in all of them
-        if not bands:
-            bands = range(1,self.ds.RasterCount+1)
-
-        # Read raster data
-        data = np.zeros((len(bands), xcount, ycount))
-        mask = np.zeros((len(bands), xcount, ycount), np.bool)
+            ycount, xcount = weights.shape
+        
+        return (xoff, yoff, xcount, ycount), weights
+        
+        
+    def readRegion(self, offsets, bands):
+        xoff, yoff, xcount, ycount = offsets
+        
+        # Read raster data of all the bands at once, in its native data type
+        data = self.ds.ReadAsArray(xoff, yoff, xcount, ycount, band_list=list(bands))
+        data = data.reshape((len(bands), ycount, xcount))
+        mask = nodataMask(data, [self.ds.GetRasterBand(b).GetNoDataValue() for b in bands])
         nd = self.metadata['nodata']
-        for b in bands:
-            band = self.ds.GetRasterBand(b)
-            d = band.ReadAsArray(xoff, yoff, xcount, ycount).astype(np.float)
-            mask[b-1,:,:] = np.equal(d,band.GetNoDataValue()) + np.equal(d,nd)
-            data[b-1,:,:] = d
+        if nd is not None:
+            mask |= np.equal(data, nd)
             
-        data = np.ma.MaskedArray(data, mask)    
-        return data, weights
+        return np.ma.MaskedArray(data, mask)
         
         
     def getRasterOffset(self, point):
@@ -251,3 +543,93 @@ class Asset:
         
 #### END DATASET CLASS ####
 
+
+
+class SourceIndex(object):
+    # Spatial index of the footprints of the sources mosaicked by a VRT. Uses an
+    # R-tree when the rtree package is available, or else a vectorized search
+    # over the footprints, which is fast enough for thousands of sources.
+    def __init__(self, footprints):
+        self.footprints = np.array(sorted(set(footprints)), np.float64).reshape((-1,4))
+        self.rtree = None
+        if rtree is not None:
+            self.rtree = rtree.Index()
+            for i, f in enumerate(self.footprints):
+                self.rtree.insert(i, tuple(f))
+    
+    @classmethod
+    def fromVRT(cls, path):
+        # Footprints are read from each source's DstRect, in the VRT's georeferenced
+        # coordinates. Returns None for VRTs (e.g. warped ones) with no such sources.
+        try:
+            vrt = ElementTree.parse(path).getroot()
+            t = [float(v) for v in vrt.find('GeoTransform').text.split(',')]
+        except (IOError, ElementTree.ParseError, AttributeError):
+            return None
+        
+        footprints = []
+        for band in vrt.iter('VRTRasterBand'):
+            for source in band:
+                if source.tag not in VRT_SOURCES:
+                    continue
+                rect = source.find('DstRect')
+                if rect is None:
+                    # Sources without a DstRect cover the whole raster
+                    return None
+                x, y, w, h = [float(rect.get(k)) for k in ('xOff', 'yOff', 'xSize', 'ySize')]
+                X = (t[0] + t[1]*x, t[0] + t[1]*(x+w))
+                Y = (t[3] + t[5]*y, t[3] + t[5]*(y+h))
+                footprints.append((min(X), min(Y), max(X), max(Y)))
+        
+        if not footprints:
+            return None
+        return cls(footprints)
+        
+    def query(self, bounds):
+        # Indexes of the footprints intersecting bounds (xmin, ymin, xmax, ymax)
+        if self.rtree is not None:
+            return sorted(self.rtree.intersection(tuple(bounds)))
+        
+        F = self.footprints
+        xmin, ymin, xmax, ymax = bounds
+        hits = (F[:,0] <= xmax) & (F[:,2] >= xmin) & (F[:,1] <= ymax) & (F[:,3] >= ymin)
+        return list(np.flatnonzero(hits))
+        
+    def intersects(self, bounds):
+        return len(self.query(bounds)) > 0
+
+
+
+class AssetPool(object):
+    # Process-wide LRU pool of opened Assets, safe to share between threads.
+    # An entry is reopened whenever its VRT or any of its YAML files changes.
+    def __init__(self, size=ASSET_POOL_SIZE):
+        self.size = size
+        self.lock = threading.Lock()
+        self.assets = OrderedDict()
+        
+    def get(self, name):
+        stamp = modifiedTimes(assetFiles(name))
+        with self.lock:
+            entry = self.assets.pop(name, None)
+            if entry is not None and entry[1] == stamp:
+                self.assets[name] = entry
+                return entry[0]
+        
+        # Open outside the lock so a slow open doesn't hold up other requests
+        asset = Asset(name)
+        with self.lock:
+            self.assets[name] = (asset, stamp)
+            while len(self.assets) > self.size:
+                self.assets.popitem(last=False)
+        return asset
+        
+    def clear(self):
+        with self.lock:
+            self.assets.clear()
+
+
+ASSET_POOL = AssetPool()
+
+def getAsset(name):
+    return ASSET_POOL.get(name)
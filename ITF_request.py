@@ -5,7 +5,9 @@ import json, yaml
 import imghdr
 import webapp2
 from operations import dispatch
-from cache import cache_disk
+from cache import cache_disk, cache_memory, coalesce
+import httpcache
+from Asset import assetFiles, modifiedTimes
 
 
 # Some Contants
@@ -17,8 +19,39 @@ class DataHandler(webapp2.RequestHandler):
     def get(self, path=''):
         # params keep both GET and POST values
         GET = self.request.params
-        R = parseRequest(GET)
+        request = normalizeRequest(GET)
+        
+        # Answer requests about an asset from its files' modification times,
+        # before doing any work; others from a hash of the response
+        cached = request.get('operation') not in UNCACHED_OPERATIONS
+        etag, modified, stamp = None, None, None
+        if cached and 'asset' in request:
+            stamp = requestVersion(request)
+            etag, modified = httpcache.assetValidators(request['asset'], request, stamp)
+            if httpcache.notModified(self.request, etag, modified):
+                httpcache.respondNotModified(self.response, etag, modified, httpcache.DATA_MAX_AGE)
+                return
+        
+        R = parseRequest(request)
         self.response.headers.update(R['headers'])
+        
+        if not isinstance(R['data'], basestring):
+            # Streamed results have no length up front, so the server sends
+            # them chunked, a piece at a time as they're rendered. They're
+            # made afresh each time, so get no validators.
+            self.response.app_iter = R['data']
+            return
+        
+        if stamp is not None and requestVersion(request) != stamp:
+            # The asset changed while the response was made, so it may be of either version
+            etag, modified = None, None
+        elif cached and etag is None:
+            etag, modified = httpcache.bodyValidators(R['data'])
+            if httpcache.notModified(self.request, etag, modified):
+                httpcache.respondNotModified(self.response, etag, modified, httpcache.DATA_MAX_AGE)
+                return
+        if cached:
+            httpcache.setHeaders(self.response, etag, modified, httpcache.DATA_MAX_AGE)
         self.response.write(R['data'])
 
     # Do same thing on GET and POST methods
@@ -31,34 +64,59 @@ application = webapp2.WSGIApplication([
 ], debug=True)
 
 
-# Parse web request, pass it to operations.dispatch(),
-# parse response, and return it the web app
-#@cache_disk(CACHE_PATH)
-def parseRequest(request):
+# Operations whose responses change from one call to the next
+UNCACHED_OPERATIONS = ('stats',)
+
+# Lowercase parameter names, and unpack requests sent as a single json or yaml parameter
+def normalizeRequest(request):
     request = {k.lower():v  for k,v in request.iteritems()}
     if len(request) == 1:
         if 'json' in request:
             request.update(json.loads(request['json']))
         elif 'yaml' in request:
             request.update(yaml.safe_load(request['yaml']))
+    return request
+    
+
+# Parse web request, pass it to operations.dispatch(),
+# parse response, and return it the web app
+def parseRequest(request):
+    request = normalizeRequest(request)
+    
+    if request.get('operation') in UNCACHED_OPERATIONS:
+        return respond.uncached(request)
+    return respond(request)
     
+    
+def requestVersion(request):
+    # Responses about an asset are of its files as they were when made
+    if 'asset' in request:
+        return modifiedTimes(assetFiles(request['asset']))
+    return None
+
+
+# Responses are cached by the normalized request and the version of the asset
+# it names, in memory and on disk, and concurrent identical requests are
+# answered once. Streams aren't cached.
+@cache_memory(version=requestVersion)
+@coalesce(CACHE_PATH, version=requestVersion)
+@cache_disk(CACHE_PATH, version=requestVersion)
+def respond(request):
     # dispatch() should always return a binary string of data
     # Support detecting different kinds of data and responding
     # with appropriate headers back to the webapp.
     R = {'headers':{}, 'data':''}
     R['data'] = dispatch(request)
+    if not isinstance(R['data'], basestring):
+        # A stream, which can't be inspected without consuming it
+        return R
     
     # Detect if an image, and if so, add an image Content-Type
     #imghdr returns None if image isn't detected
     img = imghdr.what('', R['data'])
+    if not img and R['data'][:4] == 'RIFF' and R['data'][8:12] == 'WEBP':
+        img = 'webp'
     if img: 
         R['headers'].update({'Content-Type': "image/"+img})
     
     return R
-    
-
-
-
-
-
-
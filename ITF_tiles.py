@@ -2,81 +2,116 @@ import sys
 sys.path.append('/var/www/html/mapping/stmap/')
 
 import webapp2
-from operations import dispatch
-from cache import cache_disk
-from timeout_decorator import timeout
+from cache import cache_disk, cache_memory, coalesce
+from renderer import render, Overloaded, DeadlineExceeded
+from tms import TMS_SRS, TILE_SIZE, tileCommand, tileBounds, boundsOverlap
+from pyramid import readTile
+from Asset import getAsset, assetFiles, modifiedTimes
+import Outputs
+import httpcache
 
 REQUEST_PATH = '/TMS/';
 CACHE_PATH = '/data/apicache/'
 
+# Seconds a tile may take, queueing included, before the request gives up
+TILE_DEADLINE = 5
+
+# Tiles are PNG unless the request asks for another image format
+DEFAULT_FORMAT = 'png'
+
+def tileFormat(request, extension=None):
+    # The `output` parameter wins, then the path's extension, then the Accept header
+    output = request.params.get('output', extension)
+    if output and output.lower() in Outputs.IMAGE_TYPES:
+        return output.lower()
+    if 'image/webp' in request.headers.get('Accept', ''):
+        return 'webp'
+    return DEFAULT_FORMAT
+
+def tileReducers(request):
+    # Reducers of the tile's bands, as a comma separated `reducers` parameter,
+    # e.g. ?reducers=t_slope for the trend over a date range; or None
+    reducers = request.params.get('reducers')
+    if not reducers:
+        return None
+    return [r.strip() for r in reducers.split(',')]
+
 # WebApp2 servlet to handle requests for WMS tiles
 class TileHandler(webapp2.RequestHandler):
-    def get(self, *path):
-        # params keep both GET and POST values
-        query_data = self.request.params
-        R = parseTileRequest(*path)
-        self.response.headers['Content-Type'] = "image/png"
+    def get(self, asset, date, zoom, x, y, extension=None):
+        output = tileFormat(self.request, extension)
+        reducers = tileReducers(self.request)
+        
+        # Tiles of a single date only change when the asset does, so they're kept for long
+        maxAge = httpcache.TILE_MAX_AGE if httpcache.isDated(date) else httpcache.DATA_MAX_AGE
+        stamp = tileVersion(asset)
+        etag, modified = httpcache.assetValidators(asset, [date, zoom, x, y, output, reducers], stamp)
+        if httpcache.notModified(self.request, etag, modified):
+            httpcache.respondNotModified(self.response, etag, modified, maxAge)
+            self.response.headers['Vary'] = 'Accept'
+            return
+        
+        try:
+            R = getTile(asset, date, zoom, x, y, output, reducers, stamp)
+        except Overloaded:
+            # Too many tiles queued already; ask the client to come back shortly
+            self.response.set_status(503)
+            self.response.headers['Retry-After'] = '1'
+            return
+        except DeadlineExceeded:
+            self.response.set_status(504)
+            return
+        self.response.headers['Content-Type'] = Outputs.IMAGE_TYPES[output]
+        # The format may depend on the Accept header, so caches must keep them apart
+        self.response.headers['Vary'] = 'Accept'
+        if tileVersion(asset) != stamp:
+            # The asset changed while the tile was made, so it may be of either version
+            etag, modified, maxAge = None, None, httpcache.DATA_MAX_AGE
+        httpcache.setHeaders(self.response, etag, modified, maxAge)
         self.response.write(R)
 
     # Do same thing on GET and POST methods
-    def post(self, path=''):
-        self.get(path)
+    def post(self, *path):
+        self.get(*path)
         
 # Initialize the webapp handlers.
 application = webapp2.WSGIApplication([
-    (REQUEST_PATH+'(.+?)/(.+?)/(\d+)/(\d+)/(\d+).png', TileHandler),
+    (REQUEST_PATH+'(.+?)/(.+?)/(\d+)/(\d+)/(\d+)(?:\.(png|webp|jpe?g))?', TileHandler),
 ], debug=True)
 
 
-#@cache_disk(CACHE_PATH)
+def tileVersion(asset, *args, **kwargs):
+    # Cached tiles are of the asset's files as they were when rendered
+    return modifiedTimes(assetFiles(asset))
 
-@timeout(5)
-def parseTileRequest(asset, date, zoom, x, y):
-    # Parses a request for an image tile. Request paths are in the form:
-    # http://ltweb.ceoas.oregonstate.edu/mapping/tiles/asset/band_or_date/zoom/y/x.png
 
-    # Well known text for Web Mercator projection used by Web Mapping libaries
-    # Equivillent to EPSG:3857, but without the need to look it up on disk
-    TMS_WKT = 'PROJCS["WGS 84 / Pseudo-Mercator",GEOGCS["WGS 84",DATUM["WGS_1984",SPHEROID["WGS 84",6378137,298.257223563,AUTHORITY["EPSG","7030"]],AUTHORITY["EPSG","6326"]],PRIMEM["Greenwich",0,AUTHORITY["EPSG","8901"]],UNIT["degree",0.0174532925199433,AUTHORITY["EPSG","9122"]],AUTHORITY["EPSG","4326"]],PROJECTION["Mercator_1SP"],PARAMETER["central_meridian",0],PARAMETER["scale_factor",1],PARAMETER["false_easting",0],PARAMETER["false_northing",0],UNIT["metre",1,AUTHORITY["EPSG","9001"]],AXIS["X",EAST],AXIS["Y",NORTH],EXTENSION["PROJ4","+proj=merc +a=6378137 +b=6378137 +lat_ts=0.0 +lon_0=0.0 +x_0=0.0 +y_0=0 +k=1.0 +units=m +nadgrids=@null +wktext +no_defs"],AUTHORITY["EPSG","3857"]]'
-    
+def getTile(asset, date, zoom, x, y, output=DEFAULT_FORMAT, reducers=None, stamp=None):
+    # Tiles outside of the asset's extent are blank, so they're neither
+    # rendered nor cached; every one shares the same encoded image
+    if not boundsOverlap(tileBounds(x, y, zoom), getAsset(asset).getExtent(TMS_SRS)):
+        return Outputs.getBlank(output, TILE_SIZE, TILE_SIZE)
     
-    # Determine the boundaries for the given tile
-    bounds = tileBounds(x, y, zoom)
-    
-    # Build an API call to get the tile as a PNG
-    command = {'operation': 'window',
-               'asset': asset,
-               'window': bounds,
-               'date': date,
-               'srs': TMS_WKT,
-               'srs_type': 'WKT',
-               'window_size': [256,256],
-               'output': 'PNG'
-               }
-    
-    # Dispatch the API call and return the result
-    return dispatch(command)
-    
-def tileBounds(tx, ty, zoom):
-    '''Returns bounds of the given tile in EPSG:900913 coordinates'''
-    
-    tx= float(tx); ty = float(ty); zoom=float(zoom)
-    
-    #basis = 2 * math.pi * 6378137 
-    basis = 40075016.68557849
+    # Serve pre-rendered tiles from the pyramid store when there are any
+    # that are newer than the asset
+    if output == 'png' and not reducers:
+        tile = readTile(asset, date, zoom, x, y, stamp or tileVersion(asset))
+        if tile is not None:
+            return tile
+    return parseTileRequest(asset, date, zoom, x, y, output, reducers)
 
-    z = 2**zoom;
-    ty = z-1-ty
-    minx = basis * (tx/z - 0.5)
-    miny = basis * (ty/z - 0.5)
-    maxx = basis * ((tx+1)/z - 0.5)
-    maxy = basis * ((ty+1)/z - 0.5)
-    
-    return (minx, miny, maxx, maxy)
-    
-def googleTile(tx, ty, zoom):
-    '''Converts TMS tile coordinates to Google Tile coordinates'''
-    return (tx, 2**zoom - 1 - ty)
 
+# Tiles are cached as the image bytes themselves, on disk and, for the
+# most requested ones, in memory. Concurrent requests for a tile render it once.
+@cache_memory(version=tileVersion)
+@coalesce(CACHE_PATH, TILE_DEADLINE, version=tileVersion)
+@cache_disk(CACHE_PATH, version=tileVersion)
+def parseTileRequest(asset, date, zoom, x, y, output=DEFAULT_FORMAT, reducers=None):
+    # Parses a request for an image tile. Request paths are in the form:
+    # http://ltweb.ceoas.oregonstate.edu/mapping/tiles/asset/band_or_date/zoom/y/x.png
+    # where the extension may also be .webp or .jpg, or left off. band_or_date
+    # is anything Asset.selectBands takes, e.g. 1990-01-01..2010-12-31 with
+    # ?reducers=t_slope for the trend over those years. Tiles outside of the
+    # asset are answered by getTile, before they get here.
     
-    
\ No newline at end of file
+    # Build an API call to get the tile as an image, render it on the worker pool and return the result
+    return render(tileCommand(asset, date, zoom, x, y, output=output, reducers=reducers), TILE_DEADLINE)
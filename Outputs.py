@@ -1,46 +1,281 @@
 import os, sys
 import datetime
+import io
 import numpy as np
 import png as PNG
 
 if 'GDAL_DATA' not in os.environ:
     os.environ['GDAL_DATA'] = r'/usr/lib/anaconda/share/gdal'
-from osgeo import gdal, ogr, osr, gdalconst
+from osgeo import gdal, ogr, osr, gdalconst, gdal_array
 import json, yaml,msgpack
 
 ## Output drivers
+def toList(data):
+    # Arrays become nested lists for the text drivers, with None where masked
+    if isinstance(data, np.ndarray):
+        return data.tolist()
+    return data
+
 def toJSON(data, **kwargs):
-    return json.dumps(data)
+    return json.dumps(toList(data))
 def toYAML(data, **kwargs):
-    return yaml.dump(data)
+    return yaml.dump(toList(data))
 def toMsgPack(data, **kwargs):
-    return msgpack.packb(data)
+    return msgpack.packb(toList(data))
 def identity(*args, **kwargs):
     return (args, kwargs)
 
-def toPNG(data, ds, **kwargs):
-    image = data
-    if data.ndim == 3:
-        image = np.squeeze(image[0,:,:])
 
-    if 'legend' in ds.metadata:
-        pal = np.zeros(256, dtype=np.uint32)
-        for k,v in ds.metadata['legend'].iteritems():
-            pal[k] = v[1]
-        png = PNG.Build(image.filled(0), pal)
+def getNodata(data, ds=None):
+    # The asset's nodata value, if it can be stored in data's type
+    nodata = ds.metadata.get('nodata') if ds is not None else None
+    if nodata is None:
+        return None
+    if data.dtype.kind in 'iu':
+        info = np.iinfo(data.dtype)
+        if nodata != int(nodata) or not info.min <= nodata <= info.max:
+            return None
+        return int(nodata)
+    return float(nodata)
+
+
+def arrayParts(data, ds=None):
+    # The pieces of the binary drivers: the values with masked ones set to nodata
+    # (or left as they are when there isn't one), the mask, and the nodata value
+    data = np.ma.asanyarray(data)
+    nodata = getNodata(data, ds)
+    mask = np.ma.getmaskarray(data)
+    values = data.filled(nodata) if nodata is not None else np.ma.getdata(data)
+    return np.ascontiguousarray(values), mask, nodata
+
+
+def toArray(data, ds=None, **kwargs):
+    # A msgpack map of dtype (numpy's type string, with byte order), shape, nodata,
+    # the values as raw bytes in C order, and the mask packed 8 pixels to a byte
+    # (numpy.packbits, or None if nothing is masked). Clients can decode the
+    # values without copying, e.g. numpy.frombuffer(data, dtype).reshape(shape).
+    values, mask, nodata = arrayParts(data, ds)
+    return msgpack.packb({
+        'dtype': values.dtype.str,
+        'shape': list(values.shape),
+        'nodata': nodata,
+        'data': values.tobytes(),
+        'mask': np.packbits(mask.ravel()).tobytes() if mask.any() else None
+        }, use_bin_type=True)
+
+
+def toNPZ(data, ds=None, **kwargs):
+    # An uncompressed numpy .npz with 'data' and 'mask' arrays, and 'nodata'
+    # when there is one, readable with numpy.load
+    values, mask, nodata = arrayParts(data, ds)
+    arrays = {'data': values, 'mask': mask}
+    if nodata is not None:
+        arrays['nodata'] = np.array(nodata, values.dtype)
+    out = io.BytesIO()
+    np.savez(out, **arrays)
+    return out.getvalue()
+
+def renderImage(data, ds, mode=None):
+    # The pixels the image drivers draw for a window, as (image, palette, transparent).
+    # Modes are 'gray' (the default: the first band, through the asset's legend
+    # or scaled to 8 bits), 'rgb' and 'rgba' (a composite of the first three bands,
+    # each scaled to 8 bits, with an alpha channel from the mask), and 'gray16'
+    # (the first band's raw values, as 16 bit grayscale). The image is None
+    # when there's nothing to draw.
+    mode = (mode or 'gray').lower()
+    if data.ndim == 2:
+        data = data.reshape((1,)+data.shape)
+    
+    if mode in ('rgb', 'rgba'):
+        if data.shape[0] < 3:
+            raise ValueError('RGB output needs three bands')
+        image = data[:3,:,:]
+    else:
+        image = data[0,:,:]
+
+    if np.ma.getmaskarray(image).all():
+        return None, None, 0
+
+    if mode in ('rgb', 'rgba'):
+        channels = np.empty(image.shape[1:] + (len(mode),), np.uint8)
+        for i in range(3):
+            channels[:,:,i] = scaleTo8Bit(image[i], ds)
+        if mode == 'rgba':
+            channels[:,:,3] = np.where(np.ma.getmaskarray(image).any(axis=0), 0, 255)
+        return channels, None, 0
+    elif mode == 'gray16':
+        return to16Bit(image, ds)
+    elif 'legend' in ds.metadata:
+        pal = getPalette(ds)
+        image = image.filled(0)
+        image[(image < 0) | (image >= len(pal))] = 0
+        return image, pal, 0
+    else:
+        return scaleTo8Bit(image, ds), None, 0
+    
+    
+def to16Bit(image, ds):
+    # A band's raw values as 16 bit grayscale, for renderImage. Signed values
+    # keep their bits, so clients can read them back as such. Masked pixels
+    # take the bands' nodata value, which is drawn transparent, or if there
+    # isn't one, or it's a value some pixel really has, the lowest value no
+    # pixel has. With nothing masked, nothing is transparent.
+    mask = np.ma.getmaskarray(image)
+    values = np.ma.getdata(image).astype(np.int64).astype(np.uint16)
+    if not mask.any():
+        return values, None, None
+    
+    used = np.bincount(values[~mask], minlength=2**16) > 0
+    transparent = int(np.argmin(used))
+    for nd in (ds.ds.GetRasterBand(1).GetNoDataValue(), ds.metadata.get('nodata')):
+        if nd is not None and nd == int(nd) and -2**15 <= nd < 2**16 and not used[int(nd) & 0xFFFF]:
+            transparent = int(nd) & 0xFFFF
+            break
+    values[mask] = transparent
+    return values, None, transparent
+    
+    
+def toPNG(data, ds, compression=None, mode=None, **kwargs):
+    level, filter = PNG.getCompression(compression)
+    image, pal, transparent = renderImage(data, ds, mode)
+    
+    # Nothing to draw; share the same transparent image
+    if image is None:
+        height, width = data.shape[-2:]
+        return PNG.Blank(width, height)
+    
+    return PNG.Build(image, pal, level, filter, transparent)
+    
+    
+def toColor(image, pal=None, alpha=True):
+    # Expand grayscale or palette pixels from renderImage into RGB(A) channels,
+    # for formats without palettes. 0 is transparent, as it is in the PNGs.
+    if image.ndim == 3:
+        return image if alpha or image.shape[2] == 3 else image[:,:,:3]
+    if image.dtype != np.uint8:
+        raise ValueError('16 bit output is only available as PNG')
+    
+    if pal is None:
+        colors = np.repeat(np.arange(256, dtype=np.uint32), 3).reshape((256,3))
+        opacity = np.full(256, 255, np.uint8)
+        opacity[0] = 0
+    else:
+        colors = np.array([(0xFF & p>>16, 0xFF & p>>8, 0xFF & p) for p in pal], np.uint32)
+        if np.any(pal>=16777216):
+            opacity = (255 - (0xFF & (pal>>24))).astype(np.uint8)
+        else:
+            opacity = np.full(len(pal), 255, np.uint8)
+            opacity[0] = 0
+    
+    table = np.empty((len(colors), 4 if alpha else 3), np.uint8)
+    table[:,:3] = colors
+    if alpha:
+        table[:,3] = opacity
+    return np.take(table, image, axis=0)
+    
+    
+def encodeGDAL(driver, image, options=()):
+    # Encode (height, width, channels) pixels with a GDAL raster driver
+    bands = np.ascontiguousarray(np.rollaxis(image, 2))
+    fn = '/vsimem/image_{}_{}'.format(os.getpid(), id(bands))
+    try:
+        gdal.GetDriverByName(driver).CreateCopy(fn, gdal_array.OpenArray(bands), options=list(options))
+        f = gdal.VSIFOpenL(fn, 'rb')
+        encoded = gdal.VSIFReadL(1, gdal.VSIStatL(fn).size, f)
+        gdal.VSIFCloseL(f)
+    finally:
+        gdal.Unlink(fn)
+    return encoded
+    
+    
+def _encodeWebP(image, pal, quality=None):
+    # Lossy, unless quality is 'lossless'. Legends are always lossless, so
+    # classes keep their exact colors.
+    if quality == 'lossless' or pal is not None:
+        options = ['LOSSLESS=True']
     else:
-        image = rescaleTo8Bit(image, **ds.metadata['map-scaling'])
-        png = PNG.Build(image.filled(0))
+        options = ['QUALITY={}'.format(int(quality or 75))]
+    return encodeGDAL('WEBP', toColor(image, pal, alpha=True), options)
+    
+    
+def _encodeJPEG(image, pal, quality=None):
+    # JPEG has no transparency, so masked pixels are black
+    options = ['QUALITY={}'.format(int(quality or 85))]
+    return encodeGDAL('JPEG', toColor(image, pal, alpha=False), options)
+    
+    
+def toWebP(data, ds, mode=None, quality=None, **kwargs):
+    image, pal, transparent = renderImage(data, ds, mode)
+    if image is None:
+        height, width = data.shape[-2:]
+        return getBlank('webp', width, height)
+    return _encodeWebP(image, pal, quality)
+    
+    
+def toJPEG(data, ds, mode=None, quality=None, **kwargs):
+    image, pal, transparent = renderImage(data, ds, mode)
+    if image is None:
+        height, width = data.shape[-2:]
+        return getBlank('jpeg', width, height)
+    return _encodeJPEG(image, pal, quality)
+    
+    
+# Images with nothing drawn on them, encoded once per format and size
+_BLANK = {}
+
+def getBlank(output, width, height):
+    output = output.lower()
+    if output == 'png':
+        return PNG.Blank(width, height)
+    
+    key = (output, width, height)
+    if key not in _BLANK:
+        encode = _encodeWebP if output == 'webp' else _encodeJPEG
+        _BLANK[key] = encode(np.zeros((height, width), np.uint8), None)
+    return _BLANK[key]
+    
+    
+def getPalette(ds):
+    # The palette of an asset's legend, built once per asset. It has only as many
+    # entries as the legend needs, so small legends use fewer bits per pixel.
+    if 'palette' not in ds.cache:
+        legend = ds.metadata['legend']
+        pal = np.zeros(max(legend)+1, dtype=np.uint32)
+        for k,v in legend.iteritems():
+            pal[k] = v[1]
+        ds.cache['palette'] = pal
+    return ds.cache['palette']
     
-    return png
+    
+def getRescaleLUT(ds, dtype):
+    # rescaleTo8Bit of every value of an integer type of up to 16 bits, indexed
+    # by the values' bits as unsigned integers. Built once per asset and type.
+    key = ('rescale-lut', dtype.str)
+    if key not in ds.cache:
+        values = np.arange(2**(8*dtype.itemsize)).astype('u%d' % dtype.itemsize).view(dtype)
+        ds.cache[key] = rescaleTo8Bit(values, **ds.metadata['map-scaling'])
+    return ds.cache[key]
+    
+    
+def scaleTo8Bit(image, ds):
+    # A masked image scaled to 8 bits with the asset's map scaling, and masked
+    # pixels set to 0. Integer data of up to 16 bits is looked up in a table.
+    dtype = image.dtype
+    if dtype.kind in 'iu' and dtype.itemsize <= 2:
+        out = np.take(getRescaleLUT(ds, dtype), np.ma.getdata(image).view('u%d' % dtype.itemsize))
+    else:
+        out = np.ma.getdata(rescaleTo8Bit(image, **ds.metadata['map-scaling']))
+    out[np.ma.getmaskarray(image)] = 0
+    return out
     
     
 def rescaleTo8Bit(data, min=0, max=1):
-    data = data.astype(np.float)
+    # Single precision is plenty for an 8 bit result
+    data = data.astype(np.float32)
     min = float(min)
     max = float(max)
     
-    out = np.ceil(255*(data-min)/(max-data))
+    out = np.ceil(255*(data-min)/(max-min))
     out[out<1] = 1
     out[out>255] = 255
     
@@ -52,7 +287,12 @@ OUTPUT_DRIVERS = {
     'json': toJSON,
     'yaml': toYAML,
     'msgpack': toMsgPack,
+    'array': toArray,
+    'npz': toNPZ,
     'png': toPNG,
+    'webp': toWebP,
+    'jpeg': toJPEG,
+    'jpg': toJPEG,
     'py': identity
     }
 def getDriver(name):
@@ -62,4 +302,50 @@ def getDriver(name):
     except KeyError:
         driver = OUTPUT_DRIVERS[DEFAULT]
     return driver
+
+
+## Streaming output drivers
+# These take an iterable of blocks of bands, each a (bands, y, x) masked array,
+# plus the total number of bands, and yield the output a piece at a time. JSON
+# and msgpack produce the same bytes as their whole-result drivers.
+def streamJSON(blocks, count, **kwargs):
+    yield '['
+    first = True
+    for block in blocks:
+        for band in block:
+            yield ('' if first else ', ') + json.dumps(band.tolist())
+            first = False
+    yield ']'
+    
+def streamMsgPack(blocks, count, **kwargs):
+    packer = msgpack.Packer()
+    yield packer.pack_array_header(count)
+    for block in blocks:
+        for band in block:
+            yield packer.pack(band.tolist())
+    
+def streamArray(blocks, count, ds=None, **kwargs):
+    # A sequence of 'array' messages, one per block, to be read with msgpack.Unpacker
+    for block in blocks:
+        yield toArray(block, ds=ds)
+    
+    
+# Output drivers that can stream
+STREAM_DRIVERS = {
+    'json': streamJSON,
+    'msgpack': streamMsgPack,
+    'array': streamArray
+    }
+def getStreamDriver(name):
+    # None if the output can't be streamed
+    return STREAM_DRIVERS.get(name.lower())
+    
+    
+# Content types of the image drivers
+IMAGE_TYPES = {
+    'png': 'image/png',
+    'webp': 'image/webp',
+    'jpeg': 'image/jpeg',
+    'jpg': 'image/jpeg'
+    }
     
\ No newline at end of file
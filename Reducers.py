@@ -1,4 +1,7 @@
-import os
+import os, re
+import datetime
+import threading
+from collections import OrderedDict
 import numpy as np
 import numpy.ma as npm
 
@@ -6,6 +9,12 @@ if 'GDAL_DATA' not in os.environ:
     os.environ['GDAL_DATA'] = r'/usr/lib/anaconda/share/gdal'
 import gdal, ogr, osr
 
+# numexpr is optional; without it, fused reducer plans evaluate with numpy
+try:
+    import numexpr
+except ImportError:
+    numexpr = None
+
 
 DIM_CODES = {
     't': 0,
@@ -19,6 +28,18 @@ DIM_CODES = {
     'ns':2,
     'sn':2
     }
+
+# Percentiles and histograms over up to this many values are computed exactly,
+# by sorting; larger ones from histogram sketches. Sketches of integers of up to
+# 16 bits have a bin per value, so are exact too. Other sketches' bins are
+# logarithmically spaced, so a percentile from one is within HISTOGRAM_ERROR of
+# the true one, relative to it, however widely the data is spread. Values
+# nearer zero than HISTOGRAM_MIN count as zero. Beyond HISTOGRAM_BINS bins,
+# the lowest ones are folded together and lose that bound.
+EXACT_SIZE = 2**18
+HISTOGRAM_BINS = 4096
+HISTOGRAM_ERROR = 0.01
+HISTOGRAM_MIN = 1e-9
     
 def _chooseRandom(A, axis, keepdims='Unused', weights=None):
     sh = A.shape
@@ -67,6 +88,22 @@ def _overengineeredChooseRandom(data, axis, keepdims=True):
         data = data.swapaxes(a,0)
     
     
+def _weights(A, weights):
+    # Weights broadcast to the shape of A, masked wherever A is. These are floats,
+    # so weighted reducers promote integer data only while they compute.
+    W = np.broadcast_to(np.asarray(weights, np.float64), A.shape)
+    return npm.MaskedArray(W, npm.getmaskarray(A))
+    
+    
+def _mean(A, axis=0, keepdims=True, weights=None):
+    # Integer data is accumulated in float64 by numpy, without upcasting A itself
+    if weights is None:
+        return npm.mean(A, axis=axis, keepdims=keepdims)
+    else:
+        W = _weights(A, weights)
+        return npm.sum(A*W, axis=axis, keepdims=keepdims) / npm.sum(W, axis=axis, keepdims=keepdims)
+    
+    
 def _std(A, axis=0, keepdims=True, weights=None):
     if weights is None:
         return npm.std(A, axis=axis, keepdims=keepdims)
@@ -78,57 +115,371 @@ def _var(A, axis=0, keepdims=True, weights=None):
     if weights is None:
         return npm.var(A, axis=axis, keepdims=keepdims)
     else:
-        mu = npm.average(A, axis=axis, keepdims=keepdims, weights=weights)
-        w = npm.sum(weights, axis=axis, keepdims=keepdims)
-        var = npm.sum( weights*(A-mu)**2, axis=axis, keepdims=keepdims, weights=weights) / w**2
-        return var
-        
-def _weighted_median(A, W):
-    J = np.argsort(A)
-    B = A[J]
-    W = weights[J]
-    s = np.sum(W)/2
-    cs = 0
-    for n in range(len(W)):
-        cs += W[n]
-        if cs > s:
-            return B[n]
-        if cs == s: 
-            return (B[n]+B[n+1])/2
-    
-    return 0
+        W = _weights(A, weights)
+        w = npm.sum(W, axis=axis, keepdims=True)
+        mu = npm.sum(A*W, axis=axis, keepdims=True) / w
+        var = npm.sum(W*(A-mu)**2, axis=axis, keepdims=True) / w
+        return var if keepdims else npm.squeeze(var, axis=axis)
+        
+def _reducedLast(A, axis):
+    # A with the axes being reduced moved to the end and flattened into one,
+    # and the shape of the rest
+    axes = range(A.ndim) if axis is None else np.atleast_1d(axis).tolist()
+    axes = [a % A.ndim for a in axes]
+    kept = [a for a in range(A.ndim) if a not in axes]
+    A = A.transpose(kept + axes)
+    shape = A.shape[:len(kept)]
+    return A.reshape(shape + (-1,)), shape, axes
+    
+    
+def _percentile(A, q, axis=0, keepdims=True, weights=None):
+    # Weighted percentile q (0-100) of a masked array over any axes, without
+    # looping in Python. Values are sorted along the reduced axes with masked
+    # ones last; the percentile is the first value whose cumulative weight
+    # reaches q% of the total, or the mean of it and the next value when it
+    # lands exactly on the boundary between them (so the median of an even
+    # number of equally weighted values is the mean of the middle two).
+    if weights is None:
+        weights = 1.0
+    W = npm.filled(_weights(A, weights), 0)
+    V = npm.getdata(A)
+    
+    V, shape, axes = _reducedLast(V, axis)
+    W = _reducedLast(W, axis)[0]
+    M = _reducedLast(npm.getmaskarray(A), axis)[0]
+    
+    # Sort by value, masked values last
+    order = np.lexsort((V, M), axis=-1)
+    V = np.take_along_axis(V, order, axis=-1)
+    W = np.take_along_axis(W, order, axis=-1)
+    
+    cw = np.cumsum(W, axis=-1)
+    total = cw[..., -1:]
+    target = total * (float(q) / 100)
+    
+    # The first value reaching the target, and the value after it. Cumulative
+    # weights are rounded, so both are picked to within the same tolerance
+    # that decides whether the target falls on the boundary between them.
+    tol = 1e-12 * total
+    counted = W > 0
+    i = np.argmax((cw >= target - tol) & counted, axis=-1)[..., np.newaxis]
+    j = np.argmax((cw > target + tol) & counted, axis=-1)[..., np.newaxis]
+    j = np.where(np.take_along_axis(cw, j, axis=-1) > target + tol, j, i)
+    
+    vi = np.take_along_axis(V, i, axis=-1).astype(np.float64)
+    vj = np.take_along_axis(V, j, axis=-1).astype(np.float64)
+    boundary = np.abs(np.take_along_axis(cw, i, axis=-1) - target) <= tol
+    P = np.where(boundary, (vi + vj) / 2, vi)[..., 0]
+    P = npm.MaskedArray(P, total[..., 0] <= 0)
+    
+    if keepdims:
+        for a in sorted(axes):
+            P = npm.expand_dims(P, a)
+    return P
         
         
 def _median(A, axis=0, keepdims=True, weights=None):
     if weights is None:
         return npm.median(A, axis=axis, keepdims=keepdims)
     else:
-        sh = A.shape
-        A = A.reshape((sh[0], -1))
-    
-        if axis == 0:
-            # Reduce Temporal (with a optimization for the common case of all spatial-weights being the same for each time step)
-            med = npm.median(A, axis=0)
-            M = np.not_equal(weights[0,:,:] , np.bitwise_and.reduce(weights, axis=0))
-            D = A[:,M]
-                
-            # Only loop throught those that have different weights in each time step
-            for j in range(D.shape[1]):
-                med[j] = _weighted_median(D[:,j], weights[:,j])
-                
-            med = med.reshape((1,sh[1],sh[2]))
-
-        else: #axis = (1,2)
-            # Reduce Spatial
-            med = np.zeros((sh[0]))
-            for i in range(sh[0]):
-                med[i] = _weighted_median(A[i,:], weights[i,:])
-                
-            med = med.reshape((sh[0],1,1))
-        
-        return med
+        return _percentile(A, 50, axis=axis, keepdims=keepdims, weights=weights)
+
 
+class Histogram(object):
+    # A mergeable histogram sketch: weighted counts by bin key, for the bins
+    # with any values in them. Exact sketches have a bin per integer. Others
+    # are DDSketches: the key of a value v is the sign of v times
+    # ceil(log(|v| / HISTOGRAM_MIN) / log(gamma)), 0 for values nearer zero,
+    # with gamma = (1+e)/(1-e) for e = HISTOGRAM_ERROR. A bin's value is within
+    # e of anything in it, relative to that. Every sketch has the same bins, so
+    # sketches merge by adding counts. Results are kept within the smallest
+    # and largest values seen.
+    LOG_GAMMA = np.log((1 + HISTOGRAM_ERROR) / (1 - HISTOGRAM_ERROR))
+    
+    def __init__(self, exact=False):
+        self.exact = exact
+        self.maxBins = 2**16 if exact else HISTOGRAM_BINS
+        self.keys = np.zeros(0, np.int64)
+        self.counts = np.zeros(0)
+        self.min = self.max = None
+        
+    @classmethod
+    def forType(cls, dtype):
+        return cls(dtype.kind in 'iub' and dtype.itemsize <= 2)
         
+    @classmethod
+    def of(cls, A, weights=None):
+        # Histogram of the unmasked values of A, weighted like A's reducers
+        h = cls.forType(A.dtype)
+        h.add(A, weights)
+        return h
+        
+    def isEmpty(self):
+        return not len(self.keys)
+        
+    def key(self, values):
+        if self.exact:
+            return np.rint(values).astype(np.int64)
+        scale = np.log(np.maximum(np.abs(values), HISTOGRAM_MIN) / HISTOGRAM_MIN)
+        return (np.sign(values) * np.ceil(scale / self.LOG_GAMMA)).astype(np.int64)
+        
+    def magnitude(self, keys):
+        # HISTOGRAM_MIN * gamma**keys, in logs so large keys don't overflow
+        return np.exp(np.log(HISTOGRAM_MIN) + keys * self.LOG_GAMMA)
+        
+    def add(self, A, weights=None):
+        mask = npm.getmaskarray(A)
+        values = npm.getdata(A)[~mask].astype(np.float64)
+        W = None
+        if weights is not None:
+            W = npm.getdata(_weights(A, weights))[~mask]
+            values, W = values[W > 0], W[W > 0]
+        if not len(values):
+            return
+        
+        h = Histogram(self.exact)
+        h.keys, index = np.unique(self.key(values), return_inverse=True)
+        h.counts = np.bincount(index, W, len(h.keys)).astype(np.float64)
+        h.min, h.max = values.min(), values.max()
+        self.merge(h)
+        
+    def merge(self, other):
+        if other.isEmpty():
+            return
+        if self.isEmpty():
+            self.keys, self.counts = other.keys.copy(), other.counts.copy()
+            self.min, self.max = other.min, other.max
+            return
+        
+        self.keys, index = np.unique(np.concatenate([self.keys, other.keys]), return_inverse=True)
+        self.counts = np.bincount(index, np.concatenate([self.counts, other.counts]), len(self.keys))
+        self.min, self.max = min(self.min, other.min), max(self.max, other.max)
+        
+        # Fold the lowest bins into one, keeping the highest of their keys
+        extra = len(self.keys) - self.maxBins
+        if extra > 0:
+            self.counts = np.concatenate([[self.counts[:extra+1].sum()], self.counts[extra+1:]])
+            self.keys = self.keys[extra:]
+        
+    def copy(self):
+        h = Histogram(self.exact)
+        h.keys, h.counts, h.min, h.max = self.keys.copy(), self.counts.copy(), self.min, self.max
+        return h
+        
+    def edges(self):
+        # The lower edge of each bin, which for exact histograms is its value
+        k = self.keys
+        if self.exact:
+            return k.astype(np.float64)
+        return np.where(k > 0, self.magnitude(k-1), -self.magnitude(np.abs(k)))
+        
+    def values(self):
+        # The value each bin stands for: its value when exact, else the one
+        # with the least relative error over the bin
+        k = self.keys
+        if self.exact:
+            return k.astype(np.float64)
+        gamma = np.exp(self.LOG_GAMMA)
+        return np.sign(k) * np.where(k == 0, 0, self.magnitude(np.abs(k)) * 2 / (1 + gamma))
+        
+    def percentile(self, q):
+        # Like _percentile, with each bin standing for its values
+        if self.isEmpty() or self.counts.sum() <= 0:
+            return npm.masked
+        cw = np.cumsum(self.counts)
+        target = cw[-1] * (float(q) / 100)
+        tol = 1e-12 * cw[-1]
+        i = np.argmax(cw >= target - tol)
+        values = self.values()
+        if abs(cw[i] - target) <= tol and i+1 < len(cw):
+            p = (values[i] + values[i+1]) / 2
+        else:
+            p = values[i]
+        return min(max(p, self.min), self.max)
+        
+        
+def _reducedSize(A, axis):
+    # The number of values reduced into each result
+    if axis is None:
+        return A.size
+    return int(np.prod([A.shape[a] for a in np.atleast_1d(axis)]))
+    
+    
+def _isSpatial(axis):
+    return axis is not None and sorted(np.atleast_1d(axis).tolist()) == [1, 2]
+    
+    
+def _bandHistograms(A, axis, weights=None):
+    # A Histogram of each band, for spatial axes, or of everything
+    if axis is None:
+        return [Histogram.of(A, weights)]
+    W = None if weights is None else _weights(A, weights)
+    return [Histogram.of(A[b], None if W is None else W[b]) for b in range(A.shape[0])]
+    
+    
+def percentileReducer(q):
+    # The reducer of the q-th percentile, e.g. 'p95' or 's_p5'. Reductions over
+    # space, or everything, of more than EXACT_SIZE values use histogram
+    # sketches, which are within HISTOGRAM_ERROR of the exact percentile.
+    q = float(q)
+    if not 0 <= q <= 100:
+        raise ValueError('Percentiles must be between 0 and 100, not {}'.format(q))
+    def reducer(A, axis=0, keepdims=True, weights=None):
+        if _reducedSize(A, axis) <= EXACT_SIZE or not (axis is None or _isSpatial(axis)):
+            return _percentile(A, q, axis=axis, keepdims=keepdims, weights=weights)
+        P = [h.percentile(q) for h in _bandHistograms(A, axis, weights)]
+        return _sketchResult(P, axis, keepdims)
+    reducer.q = q
+    return reducer
+    
+    
+def _sketchResult(P, axis, keepdims):
+    # A list of per band (or overall) results, some of which may be masked,
+    # shaped like a reduction of a (bands, y, x) stack
+    masked = [p is npm.masked for p in P]
+    P = npm.MaskedArray([0.0 if m else p for p, m in zip(P, masked)], masked, dtype=np.float64)
+    if axis is None:
+        P = P.reshape(())
+        return P.reshape((1,1,1)) if keepdims else P
+    return P.reshape((-1,1,1)) if keepdims else P
+    
+    
+def histogramTable(histograms):
+    # Histograms brought to the same bins, as a (histograms, 2, bins) array of
+    # each bin's lower edge and its (weighted) count. Bins that are empty in
+    # all of them are left out.
+    merged = Histogram(all(h.exact for h in histograms))
+    for h in histograms:
+        merged.merge(h)
+    if merged.isEmpty():
+        return npm.masked_all((len(histograms), 2, 0))
+    
+    table = np.zeros((len(histograms), 2, len(merged.keys)))
+    table[:,0,:] = merged.edges()
+    for n, h in enumerate(histograms):
+        # Bins folded together in the merged histogram fall into its first one
+        np.add.at(table[n,1], np.searchsorted(merged.keys, h.keys), h.counts)
+    return npm.MaskedArray(table)
+    
+    
+def _histogram(A, axis=(1,2), keepdims=True, weights=None):
+    # Histograms of each band over space, or of everything, as rows of bin
+    # lower edges and counts: (bands, 2, bins), or (1, 2, bins). Exact for
+    # integers of up to 16 bits, whose bins are one value wide; otherwise
+    # bins are HISTOGRAM_ERROR wide relative to their values (see Histogram).
+    if not (axis is None or _isSpatial(axis)):
+        raise ValueError('Histograms are of each band over space, or of everything')
+    return histogramTable(_bandHistograms(A, axis, weights))
+    
+    
+## Trend reducers
+# Per pixel trends over time (axis 0), from the dates of the bands. They're
+# computed for all pixels at once; masked values are left out of each pixel's
+# series, and pixels with too few values to have a trend are masked.
+
+# Pairs of values per pixel that Theil-Sen works on at a time
+THEIL_SEN_CHUNK = 2**22
+
+def _years(dates):
+    # Dates as decimal years, e.g. 1990-07-02 as 1990.5
+    years = []
+    for d in dates:
+        if d is None:
+            raise ValueError('Trends need a date for every band')
+        start = datetime.date(d.year, 1, 1)
+        length = (datetime.date(d.year+1, 1, 1) - start).days
+        years.append(d.year + float((d - start).days) / length)
+    return np.array(years)
+    
+    
+def _trendAxis(A, axis, dates):
+    if axis not in (0, None):
+        raise ValueError('Trends are over time')
+    if dates is None or len(dates) != A.shape[0]:
+        raise ValueError('Trends need the dates of the bands')
+    return _years(dates).reshape((-1,) + (1,)*(A.ndim-1))
+    
+    
+def _trendResult(T, invalid, keepdims):
+    T = npm.MaskedArray(T, invalid)
+    return T if keepdims else T[0]
+    
+    
+def _slope(A, axis=0, keepdims=True, weights=None, dates=None):
+    # Ordinary least squares slope, in units per year
+    t = _trendAxis(A, axis, dates)
+    valid = ~npm.getmaskarray(A)
+    Y = npm.getdata(A).astype(np.float64)
+    
+    n = np.sum(valid, axis=0, keepdims=True)
+    safe = np.where(n > 0, n, 1)
+    tm = np.sum(valid*t, axis=0, keepdims=True) / safe
+    ym = np.sum(np.where(valid, Y, 0), axis=0, keepdims=True) / safe
+    dt = np.where(valid, t - tm, 0)
+    sxx = np.sum(dt**2, axis=0, keepdims=True)
+    sxy = np.sum(dt*np.where(valid, Y - ym, 0), axis=0, keepdims=True)
+    
+    invalid = (n < 2) | (sxx <= 0)
+    return _trendResult(sxy / np.where(invalid, 1, sxx), invalid, keepdims)
+    
+    
+def _theilSen(A, axis=0, keepdims=True, weights=None, dates=None):
+    # Theil-Sen slope: the median of the slopes between every pair of dates,
+    # which outliers such as a missed cloud barely move. In units per year.
+    t = _trendAxis(A, axis, dates).ravel()
+    i, j = np.triu_indices(len(t), 1)
+    i, j = i[t[j] != t[i]], j[t[j] != t[i]]
+    
+    shape = A.shape[1:]
+    Y = npm.getdata(A).reshape((A.shape[0], -1)).astype(np.float64)
+    M = npm.getmaskarray(A).reshape((A.shape[0], -1))
+    dt = (t[j] - t[i]).reshape((-1, 1))
+    
+    # Pairs of every pixel at once would take too much memory for long series,
+    # so go through the pixels a chunk at a time
+    T = npm.masked_all(Y.shape[1])
+    step = max(1, THEIL_SEN_CHUNK // max(len(i), 1))
+    for p in range(0, Y.shape[1], step):
+        slopes = (Y[j, p:p+step] - Y[i, p:p+step]) / dt
+        T[p:p+step] = npm.median(npm.MaskedArray(slopes, M[i, p:p+step] | M[j, p:p+step]), axis=0)
+    
+    T = T.reshape((1,) + shape)
+    return T if keepdims else T[0]
+    
+    
+def _compact(V, valid):
+    # Each pixel's valid values moved to the front of axis 0, in order, and
+    # which of the positions now hold one
+    order = np.argsort(~valid, axis=0, kind='mergesort')
+    return np.take_along_axis(V, order, axis=0), np.take_along_axis(valid, order, axis=0)
+    
+    
+def _change(A, axis=0, keepdims=True, weights=None, dates=None):
+    # Change magnitude: each pixel's last value less its first
+    _trendAxis(A, axis, dates)
+    V, valid = _compact(npm.getdata(A).astype(np.float64), ~npm.getmaskarray(A))
+    n = np.sum(valid, axis=0, keepdims=True)
+    last = np.take_along_axis(V, np.maximum(n-1, 0), axis=0)
+    return _trendResult(last - V[:1], n < 1, keepdims)
+    
+    
+def _breaks(A, axis=0, keepdims=True, weights=None, dates=None):
+    # Breakpoint count: how many times a pixel's series turns around, counting
+    # only steps between consecutive values larger than its standard deviation,
+    # so noise around a steady value doesn't count
+    _trendAxis(A, axis, dates)
+    V, valid = _compact(npm.getdata(A).astype(np.float64), ~npm.getmaskarray(A))
+    sd = npm.filled(npm.std(npm.MaskedArray(V, ~valid), axis=0, keepdims=True), 0)
+    
+    steps = np.diff(V, axis=0)
+    significant = valid[1:] & valid[:-1] & (np.abs(steps) > sd)
+    S, significant = _compact(np.sign(steps), significant)
+    turns = significant[1:] & significant[:-1] & (S[1:] != S[:-1])
+    
+    n = np.sum(valid, axis=0, keepdims=True)
+    return _trendResult(np.sum(turns, axis=0, keepdims=True), n < 3, keepdims)
+    
+    
 def _min(A, axis=0, keepdims=True, weights=None):
     # Weights don't matter
     return npm.min(A, axis=axis, keepdims=keepdims)
@@ -137,47 +488,407 @@ def _max(A, axis=0, keepdims=True, weights=None):
     # Weights don't matter
     return npm.max(A, axis=axis, keepdims=keepdims)
     
+def _count(A, axis=0, keepdims=True, weights=None):
+    # The number of unmasked values, or their total weight
+    if weights is None:
+        return npm.count(A, axis=axis, keepdims=keepdims)
+    else:
+        W = npm.filled(_weights(A, weights), 0)
+        return npm.MaskedArray(np.sum(W, axis=axis, keepdims=keepdims))
+    
+def _sum(A, axis=0, keepdims=True, weights=None):
+    if weights is None:
+        return npm.sum(A, axis=axis, keepdims=keepdims)
+    else:
+        return npm.sum(A*_weights(A, weights), axis=axis, keepdims=keepdims)
+    
     
     
    
 REDUCERS = {
-    'mean': npm.average,
+    'mean': _mean,
     'std':  _std,
     'var': _var,
     'median': _median,
     'min': _min,
     'max': _max,
+    'count': _count,
+    'sum': _sum,
+    'histogram': _histogram,
+    'slope': _slope,
+    'theilsen': _theilSen,
+    'change': _change,
+    'breaks': _breaks,
     'random': _chooseRandom
 }    
-def apply(R, data, weights=None):
 
-    if not hasattr(R, 'iter'):
-        R = [R]
+# Reducers that need the dates of the bands
+DATED_REDUCERS = (_slope, _theilSen, _change, _breaks)
+
+# Percentile reducers are named p<percentile>, e.g. p5, p95 or p99.9
+PERCENTILE_NAME = re.compile(r'^p(\d+(\.\d+)?)$')
+
+
+def resultType(reducer, dtype, weighted):
+    # The dtype apply() gives a reducer's results for data of dtype, e.g. integers
+    # for sums and counts of integers. Accumulators and fused plans compute in
+    # float64, and cast back to this, so every path gives the same results.
+    # Only called for the fixed reducers of STATISTICS, so this stays small
+    key = (reducer, np.dtype(dtype), weighted)
+    if key not in RESULT_TYPES:
+        sample = npm.MaskedArray(np.zeros((1,1,1), dtype), np.zeros((1,1,1), bool))
+        RESULT_TYPES[key] = reducer(sample, axis=0, keepdims=True, weights=1.0 if weighted else None).dtype
+    return RESULT_TYPES[key]
+    
+RESULT_TYPES = {}
     
-    if data.ndim == 2:
-        data = data.reshape((1, data.shape[0], data.shape[1]))
+    
+def _castResult(values, dtype):
+    # float64 results as dtype, rounding those that go back to integers
+    if dtype.kind in 'iub':
+        values = np.rint(values)
+    return values.astype(dtype)
+    
+    
+## Streaming reducers
+# Accumulators reduce blocks of bands one after another, over time (axis 0)
+# or over everything (axis None), keeping only per-pixel running values, so
+# the whole (bands, y, x) stack is never in memory at once.
 
-    for r in R:
-        r = r.split('_')
-        if len(r) == 1:
-            reducer = r[0]
-            dim = None
+class Moments(object):
+    # Running weighted count, mean and sum of squared deviations, merging each
+    # block's with Chan et al.'s pairwise form of Welford's algorithm, which
+    # stays accurate where sums of squares would cancel
+    def __init__(self, axis, statistic):
+        self.axis = axis
+        self.statistic = statistic
+        self.n = self.mean = self.m2 = None
+        self.dtype = None
+        
+    def update(self, block, weights=None):
+        if self.dtype is None:
+            self.dtype = resultType(STATISTICS[self.statistic], block.dtype, weights is not None)
+        W = npm.filled(_weights(block, 1.0 if weights is None else weights), 0)
+        X = npm.filled(block, 0).astype(np.float64)
+        n = np.sum(W, axis=self.axis, keepdims=True)
+        mean = np.sum(W*X, axis=self.axis, keepdims=True) / np.where(n > 0, n, 1)
+        m2 = np.sum(W*(X-mean)**2, axis=self.axis, keepdims=True)
+        
+        if self.n is None:
+            self.n, self.mean, self.m2 = n, mean, m2
+        else:
+            total = self.n + n
+            delta = mean - self.mean
+            share = n / np.where(total > 0, total, 1)
+            self.mean = self.mean + delta*share
+            self.m2 = self.m2 + m2 + delta**2 * self.n * share
+            self.n = total
+        
+    def result(self):
+        if self.statistic == 'count':
+            return npm.MaskedArray(_castResult(self.n, self.dtype))
+        empty = self.n <= 0
+        n = np.where(empty, 1, self.n)
+        values = {
+            'sum': lambda: self.mean * self.n,
+            'mean': lambda: self.mean,
+            'var': lambda: self.m2 / n,
+            'std': lambda: np.sqrt(self.m2 / n)
+            }[self.statistic]()
+        return npm.MaskedArray(_castResult(values, self.dtype), empty)
+        
+        
+class Extrema(object):
+    # Running minimum or maximum, which weights don't change
+    def __init__(self, axis, reducer):
+        self.axis = axis
+        self.reducer = reducer
+        self.value = self.mask = None
+        
+    def update(self, block, weights=None):
+        if self.reducer is _min:
+            combine, fill = np.minimum, npm.minimum_fill_value(block)
+        else:
+            combine, fill = np.maximum, npm.maximum_fill_value(block)
+        B = self.reducer(block, axis=self.axis, keepdims=True)
+        value, mask = npm.filled(B, fill), npm.getmaskarray(B)
+        
+        if self.value is None:
+            self.value, self.mask = value, mask
         else:
-            reducer = r[1]
-            try:
-                dim = DIM_CODES[r[0]]
-            except KeyError:
-                dim = None
+            self.value = combine(self.value, value)
+            self.mask = self.mask & mask
+        
+    def result(self):
+        return npm.MaskedArray(self.value, self.mask)
+        
+        
+class Quantiles(object):
+    # Percentile of everything: exact from the values themselves while there
+    # are at most EXACT_SIZE of them, then from a histogram sketch
+    def __init__(self, q):
+        self.q = q
+        self.blocks = []
+        self.size = 0
+        self.histogram = None
+        
+    def update(self, block, weights=None):
+        if self.histogram is not None:
+            self.histogram.add(block, weights)
+            return
+        self.blocks.append((block, None if weights is None else _weights(block, weights)))
+        self.size += block.size
+        if self.size > EXACT_SIZE:
+            self.histogram = Histogram.forType(block.dtype)
+            for b, w in self.blocks:
+                self.histogram.add(b, w)
+            self.blocks = []
             
-        #try:
+    def result(self):
+        if self.histogram is not None:
+            return _sketchResult([self.histogram.percentile(self.q)], None, True)
+        A = npm.concatenate([b for b, w in self.blocks])
+        W = None
+        if any(w is not None for b, w in self.blocks):
+            W = npm.concatenate([w if w is not None else _weights(b, 1.0) for b, w in self.blocks])
+        return _percentile(A, self.q, axis=None, keepdims=True, weights=W)
+        
+        
+class Histograms(object):
+    # Running histograms of each band over space, or of everything
+    def __init__(self, axis):
+        self.axis = axis
+        self.histograms = []
+        
+    def update(self, block, weights=None):
+        if self.axis is None and self.histograms:
+            self.histograms[0].merge(Histogram.of(block, weights))
+        else:
+            self.histograms += _bandHistograms(block, self.axis, weights)
+            
+    def result(self):
+        return histogramTable(self.histograms)
         
-        reducer = REDUCERS[reducer]
         
-        #except KeyError:
-        #    reducer = REDUCERS['mean']
+def accumulator(reducer, dim):
+    # An accumulator for a reducer over blocks of bands along dim, or None
+    if dim in (0, None) and reducer in ACCUMULATORS:
+        return ACCUMULATORS[reducer](dim)
+    if dim is None and hasattr(reducer, 'q'):
+        return Quantiles(reducer.q)
+    if reducer is _histogram and (dim is None or _isSpatial(dim)):
+        return Histograms(dim)
+    return None
+    
+    
+# The reducer of each of Moments' statistics
+STATISTICS = {'mean': _mean, 'var': _var, 'std': _std, 'sum': _sum, 'count': _count}
 
+ACCUMULATORS = {
+    _mean: lambda axis: Moments(axis, 'mean'),
+    _var: lambda axis: Moments(axis, 'var'),
+    _std: lambda axis: Moments(axis, 'std'),
+    _sum: lambda axis: Moments(axis, 'sum'),
+    _count: lambda axis: Moments(axis, 'count'),
+    _min: lambda axis: Extrema(axis, _min),
+    _max: lambda axis: Extrema(axis, _max)
+}
+
+
+def parse(r):
+    # The reducer function and axis of a reducer name, e.g. 't_mean' or 's_max'
+    r = r.split('_')
+    if len(r) == 1:
+        reducer = r[0]
+        dim = None
+    else:
+        reducer = r[1]
+        try:
+            dim = DIM_CODES[r[0]]
+        except KeyError:
+            dim = None
+        
+    #try:
+    
+    percentile = PERCENTILE_NAME.match(reducer)
+    if percentile:
+        reducer = percentileReducer(percentile.group(1))
+    else:
+        reducer = REDUCERS[reducer]
+    
+    #except KeyError:
+    #    reducer = REDUCERS['mean']
+    
+    return reducer, dim
     
-        data = reducer(data, weights=weights, axis=dim, keepdims=True)
     
-    return data
+def isBandwise(R):
+    # Whether reducers only reduce within each band, so blocks of bands
+    # can be reduced one at a time
+    if isinstance(R, basestring):
+        R = [R]
+    reducers = [parse(r) for r in R]
+    return all(dim not in (None, 0) and reducer is not _histogram for reducer, dim in reducers)
+    
+    
+def isPixelwise(R):
+    # Whether reducers only reduce each pixel's values over time, so a window
+    # can be cut into pieces before or after it's reduced, alike
+    if isinstance(R, basestring):
+        R = [R]
+    return all(dim == 0 for reducer, dim in (parse(r) for r in R))
+    
+    
+## Reducer plans
+# A chain of reducers is parsed once into a Plan, and kept. When every reducer
+# in it has a kernel below, the plan runs fused: the masked array is split into
+# plain values and a validity mask once, every step works on those, and only
+# the result is masked again. Element-wise work goes through numexpr, which uses
+# all cores, when it's installed. Other chains run reducer by reducer.
+
+def _evaluate(expression, **arrays):
+    if numexpr is not None:
+        return numexpr.evaluate(expression, local_dict=arrays)
+    return eval(expression, {'where': np.where}, arrays)
+    
+    
+def _momentsKernel(statistic):
+    def kernel(X, valid, W, axis):
+        values, nonempty = moments(X, valid, W, axis)
+        return _castResult(values, resultType(STATISTICS[statistic], X.dtype, W is not None)), nonempty
+        
+    def moments(X, valid, W, axis):
+        # Integers are promoted to float64 inside the expressions, not beforehand
+        if W is None:
+            Wv = None
+            n = np.sum(valid, axis=axis, keepdims=True)
+        else:
+            W = np.broadcast_to(np.asarray(W, np.float64), X.shape)
+            Wv = _evaluate('where(valid, W, 0.0)', valid=valid, W=W)
+            n = np.sum(Wv, axis=axis, keepdims=True)
+        if statistic == 'count':
+            return n, np.ones(n.shape, bool)
+        
+        nonempty = n > 0
+        safe = np.where(nonempty, n, 1)
+        if Wv is None:
+            total = _evaluate('where(valid, X, 0.0)', valid=valid, X=X)
+        else:
+            total = _evaluate('where(valid, X*Wv, 0.0)', valid=valid, X=X, Wv=Wv)
+        total = np.sum(total, axis=axis, keepdims=True)
+        if statistic == 'sum':
+            return total, nonempty
+        mean = total / safe
+        if statistic == 'mean':
+            return mean, nonempty
+        
+        M = np.broadcast_to(mean, X.shape)
+        if Wv is None:
+            D = _evaluate('where(valid, (X-M)**2, 0.0)', valid=valid, X=X, M=M)
+        else:
+            D = _evaluate('where(valid, Wv*(X-M)**2, 0.0)', valid=valid, X=X, Wv=Wv, M=M)
+        var = np.sum(D, axis=axis, keepdims=True) / safe
+        return (var if statistic == 'var' else np.sqrt(var)), nonempty
+    return kernel
+    
+    
+def _extremaKernel(combine, fill):
+    def kernel(X, valid, W, axis):
+        F = np.where(valid, X, fill(X.dtype))
+        return combine.reduce(F, axis=axis, keepdims=True), np.any(valid, axis=axis, keepdims=True)
+    return kernel
+    
+    
+def _largest(dtype):
+    return np.inf if dtype.kind == 'f' else np.iinfo(dtype).max
+    
+def _smallest(dtype):
+    return -np.inf if dtype.kind == 'f' else np.iinfo(dtype).min
+    
+    
+KERNELS = {
+    _mean: _momentsKernel('mean'),
+    _var: _momentsKernel('var'),
+    _std: _momentsKernel('std'),
+    _sum: _momentsKernel('sum'),
+    _count: _momentsKernel('count'),
+    _min: _extremaKernel(np.minimum, _largest),
+    _max: _extremaKernel(np.maximum, _smallest)
+}
+    
+    
+class Plan(object):
+    def __init__(self, R):
+        self.steps = [parse(r) for r in R]
+        self.fused = all(reducer in KERNELS for reducer, dim in self.steps)
+        
+    def __call__(self, data, weights=None, dates=None):
+        if data.ndim == 2:
+            data = data.reshape((1, data.shape[0], data.shape[1]))
+        
+        if not self.fused:
+            for reducer, dim in self.steps:
+                if reducer in DATED_REDUCERS:
+                    data = reducer(data, weights=weights, axis=dim, keepdims=True, dates=dates)
+                else:
+                    data = reducer(data, weights=weights, axis=dim, keepdims=True)
+            return data
+        
+        X, valid = npm.getdata(data), ~npm.getmaskarray(data)
+        for reducer, dim in self.steps:
+            X, valid = KERNELS[reducer](X, valid, weights, dim)
+        return npm.MaskedArray(X, ~valid)
+        
+        
+# Plans of the most recently used reducer chains. Chains come from requests,
+# e.g. with any number of spellings of a percentile, so only so many are kept.
+PLAN_CACHE_SIZE = 256
+PLANS = OrderedDict()
+_PLANS_LOCK = threading.Lock()
 
+def getPlan(R):
+    if isinstance(R, basestring):
+        R = [R]
+    key = tuple(R)
+    with _PLANS_LOCK:
+        plan = PLANS.pop(key, None)
+        if plan is not None:
+            PLANS[key] = plan
+            return plan
+    
+    plan = Plan(key)
+    with _PLANS_LOCK:
+        PLANS[key] = plan
+        while len(PLANS) > PLAN_CACHE_SIZE:
+            PLANS.popitem(last=False)
+    return plan
+    
+    
+def apply(R, data, weights=None, dates=None):
+    # dates are those of data's bands, for the trend reducers
+    return getPlan(R)(data, weights, dates)
+    
+    
+def reduceBlocks(R, blocks, weights=None, dates=None):
+    # apply() to an iterable of blocks of bands, such as Asset.iterWindow's,
+    # without putting them together where it can be avoided: bandwise reducers
+    # reduce each block, and when the first reducer has an accumulator it runs
+    # over the blocks as they come. Anything else gets the whole stack.
+    if isinstance(R, basestring):
+        R = [R]
+    R = list(R)
+    
+    if isBandwise(R):
+        return npm.concatenate([apply(R, block, weights) for block in blocks])
+    
+    acc = accumulator(*parse(R[0]))
+    if acc is None:
+        return apply(R, npm.concatenate(list(blocks)), weights, dates)
+    
+    for block in blocks:
+        if block.ndim == 2:
+            block = block.reshape((1,) + block.shape)
+        acc.update(block, weights)
+    data = acc.result()
+    
+    return apply(R[1:], data, weights) if len(R) > 1 else data
@@ -0,0 +1,297 @@
+from __future__ import print_function
+# Benchmarks for the request path, run against the assets under Asset.DATA_PATH:
+#
+#   python benchmarks.py <benchmark> [arguments...]
+#   python benchmarks.py tiles WAORCA_biomass.default 1990-06-01 7 19 47
+#   python benchmarks.py bands WAORCA_biomass.default 0.25 256
+#   python benchmarks.py render WAORCA_biomass.default 1990-06-01 9 8
+#   python benchmarks.py viewport WAORCA_biomass.default 1990-06-01 9 4
+#   python benchmarks.py scaling WAORCA_biomass.default int16
+#   python benchmarks.py median 30 5000
+#   python benchmarks.py reducers 30 256
+
+import sys, time
+import threading
+import numpy as np
+
+
+def timeCalls(f, repeat, *args, **kwargs):
+    # Wall clock seconds of each of `repeat` calls to f
+    times = []
+    for i in range(repeat):
+        start = time.time()
+        f(*args, **kwargs)
+        times.append(time.time() - start)
+    return np.array(times)
+
+
+def report(label, times):
+    times = 1000*np.asarray(times)
+    print('{:<36} n={:<5d} median={:9.3f}ms  p99={:9.3f}ms  max={:9.3f}ms'.format(
+        label, len(times), np.median(times), np.percentile(times, 99), np.max(times)))
+
+
+def bench_tiles(asset, date, zoom, x, y, repeat=20):
+    # Latency of rendering a tile the first time, then repeatedly once the asset
+    # pool and warped VRT cache are warm. The response caches are bypassed, so
+    # this measures rendering, and leaves the server's tile cache alone; hits
+    # are timed separately, on a memory cache of the benchmark's own.
+    import ITF_tiles
+    from Asset import ASSET_POOL
+    from cache import cache_memory
+
+    render = ITF_tiles.parseTileRequest.uncached
+    ASSET_POOL.clear()
+    report('tile (cold)', timeCalls(render, 1, asset, date, zoom, x, y))
+    report('tile (repeated)', timeCalls(render, int(repeat), asset, date, zoom, x, y))
+
+    cached = cache_memory()(render)
+    cached(asset, date, zoom, x, y)
+    report('tile (memory cache hit)', timeCalls(cached, int(repeat), asset, date, zoom, x, y))
+
+
+def _readPerBand(DS, bounds, bands, size, resampleMethod=None):
+    # The former Asset.getWindow read path: one ReadAsArray per band, into float64.
+    # Reads from the same overview level as Asset.readWindow, for a fair comparison.
+    from Asset import windowOffsets
+    resampleMethod = DS.getResampleMethod(resampleMethod)
+    xoff, yoff, xcount, ycount = windowOffsets(DS.ds.GetGeoTransform(), bounds)
+    ds = DS.getDataset(DS.getOverviewLevel(xcount/size[0]))
+    xoff, yoff, xcount, ycount = windowOffsets(ds.GetGeoTransform(), bounds)
+    data = np.zeros((len(bands), size[1], size[0]))
+    mask = np.zeros((len(bands), size[1], size[0]), np.bool)
+    for i, b in enumerate(bands):
+        band = ds.GetRasterBand(b)
+        d = band.ReadAsArray(xoff, yoff, xcount, ycount, size[0], size[1], resample_alg=resampleMethod)
+        mask[i,:,:] = np.equal(d, band.GetNoDataValue())
+        data[i,:,:] = d
+    return np.ma.MaskedArray(data, mask)
+
+
+def bench_bands(asset, fraction=0.25, size=256, repeat=10):
+    # Reading every band (the whole time series) of a window at the center of
+    # the asset, spanning `fraction` of its width, one band at a time vs. all at once.
+    from Asset import getAsset
+    DS = getAsset(asset)
+    xmin, ymin, xmax, ymax = DS.getExtent()
+    dx = float(fraction) * (xmax-xmin) / 2
+    cx, cy = (xmin+xmax)/2, (ymin+ymax)/2
+    bounds = (cx-dx, cy-dx, cx+dx, cy+dx)
+    bands = range(1, DS.ds.RasterCount+1)
+    size = (int(size), int(size))
+
+    label = '{} bands'.format(len(bands))
+    report(label+', per band', timeCalls(_readPerBand, int(repeat), DS, bounds, bands, size))
+    report(label+', batched', timeCalls(DS.readWindow, int(repeat), bounds, bands, size))
+
+
+def runClients(f, calls, clients):
+    # Make the calls from `clients` concurrent threads. Returns the latency
+    # of each call, and the wall clock seconds they took altogether.
+    calls = list(calls)
+    lock = threading.Lock()
+    latencies = []
+
+    def client():
+        while True:
+            with lock:
+                if not calls:
+                    return
+                call = calls.pop()
+            start = time.time()
+            f(call)
+            with lock:
+                latencies.append(time.time() - start)
+
+    start = time.time()
+    threads = [threading.Thread(target=client) for i in range(clients)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    return latencies, time.time() - start
+
+
+def bench_render(asset, date, zoom, clients=8, tiles=64):
+    # Throughput and latency of rendering the tiles over an asset from concurrent
+    # clients, with a process forked per tile to enforce its timeout (the former
+    # model) vs. the renderer's thread pool.
+    import tms
+    from Asset import getAsset
+    from operations import dispatch
+    from timeout_decorator import timeout
+    from renderer import RenderPool
+
+    xmin, ymin, xmax, ymax = tms.tileRange(getAsset(asset).getExtent(tms.TMS_SRS), int(zoom))
+    calls = [tms.tileCommand(asset, date, zoom, x, y)
+                for x in range(xmin, xmax+1) for y in range(ymin, ymax+1)][:int(tiles)]
+    clients = int(clients)
+
+    models = [('process per tile', timeout(5, use_signals=False)(dispatch)),
+              ('thread pool', RenderPool(threads=clients, queueSize=len(calls)))]
+    for label, f in models:
+        latencies, total = runClients(f, calls, clients)
+        report(label, latencies)
+        print('{:<36} {:.1f} tiles/s'.format('', len(calls)/total))
+
+
+def bench_viewport(asset, date, zoom, n=4, repeat=5):
+    # Loading an n x n block of tiles at the center of an asset, one tile at a
+    # time vs. with a single batched 'tiles' call.
+    import tms
+    from Asset import getAsset
+    from operations import dispatch
+
+    xmin, ymin, xmax, ymax = tms.tileRange(getAsset(asset).getExtent(tms.TMS_SRS), int(zoom))
+    n = int(n)
+    x0, y0 = (xmin+xmax-n)//2 + 1, (ymin+ymax-n)//2 + 1
+
+    def perTile():
+        for x in range(x0, x0+n):
+            for y in range(y0, y0+n):
+                dispatch(tms.tileCommand(asset, date, zoom, x, y))
+
+    batch = {'operation': 'tiles', 'asset': asset, 'date': date, 'zoom': zoom,
+             'x': [x0, x0+n-1], 'y': [y0, y0+n-1]}
+
+    report('{0}x{0} viewport, per tile'.format(n), timeCalls(perTile, int(repeat)))
+    report('{0}x{0} viewport, batched'.format(n), timeCalls(dispatch, int(repeat), batch))
+
+
+def _rescaleFloat64(data, min=0, max=1):
+    # The former float64 Outputs.rescaleTo8Bit, (with its scaling corrected)
+    data = data.astype(np.float64)
+    out = np.ceil(255*(data-float(min))/(float(max)-float(min)))
+    out[out<1] = 1
+    out[out>255] = 255
+    return out.astype(np.uint8).filled(0)
+
+
+def _legendPalette(legend):
+    # The former palette, rebuilt from the legend for every tile
+    pal = np.zeros(256, dtype=np.uint32)
+    for k,v in legend.items():
+        pal[k] = v[1]
+    return pal
+
+
+def bench_scaling(asset, dtype='int16', size=256, repeat=200):
+    # CPU time spent turning a window of `dtype` values into 8 bit pixels per tile,
+    # with float arithmetic vs. the per-asset lookup table; and building the palette
+    # for every tile vs. once per asset.
+    import Outputs
+    from Asset import getAsset
+    DS = getAsset(asset)
+    scaling = DS.metadata['map-scaling']
+    lo, hi = float(scaling['min']), float(scaling['max'])
+
+    size = int(size)
+    values = lo + (hi-lo)*np.random.rand(size, size)*1.2
+    data = np.ma.MaskedArray(values.astype(dtype), np.random.rand(size, size) < 0.1)
+
+    report('rescale, float64', timeCalls(_rescaleFloat64, int(repeat), data, **scaling))
+    report('rescale, lookup table', timeCalls(Outputs.scaleTo8Bit, int(repeat), data, DS))
+    if 'legend' in DS.metadata:
+        report('palette, per tile', timeCalls(_legendPalette, int(repeat), DS.metadata['legend']))
+        report('palette, per asset', timeCalls(Outputs.getPalette, int(repeat), DS))
+
+
+def _loopWeightedMedian(A, W):
+    # The former Reducers._weighted_median, one column of values at a time
+    J = np.argsort(A)
+    B = A[J]
+    W = W[J]
+    s = np.sum(W)/2
+    cs = 0
+    for n in range(len(W)):
+        cs += W[n]
+        if cs > s:
+            return B[n]
+        if cs == s:
+            return (B[n]+B[n+1])/2
+    return 0
+
+
+def _loopMedian(A, weights, axis):
+    # The former weighted Reducers._median: a Python loop over bands for spatial
+    # medians, and over every pixel for temporal ones
+    sh = A.shape
+    A = A.reshape((sh[0], -1))
+    W = np.broadcast_to(weights, sh).reshape((sh[0], -1))
+    if axis == 0:
+        med = np.zeros(A.shape[1])
+        for j in range(A.shape[1]):
+            med[j] = _loopWeightedMedian(A[:,j].compressed(), W[:,j][~A.mask[:,j]])
+        return med.reshape((1, sh[1], sh[2]))
+    med = np.zeros(sh[0])
+    for i in range(sh[0]):
+        med[i] = _loopWeightedMedian(A[i,:].compressed(), W[i,:][~A.mask[i,:]])
+    return med.reshape((sh[0], 1, 1))
+
+
+def bench_median(bands=30, pixels=5000, repeat=5):
+    # Weighted medians of a region of `pixels` pixels over `bands` years, with
+    # fractional pixel weights and 10% of values masked, over time and over space:
+    # the former per-pixel loops vs. the vectorized Reducers._percentile.
+    import Reducers
+    bands, side = int(bands), int(np.sqrt(int(pixels)))
+    shape = (bands, side, side)
+    data = np.ma.MaskedArray(np.random.randint(0, 500, shape).astype(np.int16), np.random.rand(*shape) < 0.1)
+    weights = np.random.rand(side, side)
+
+    for name, axis in (('temporal', 0), ('spatial', (1,2))):
+        label = '{} median, {}x{}x{}'.format(name, *shape)
+        report(label+', loop', timeCalls(_loopMedian, int(repeat), data, weights, axis))
+        report(label+', vectorized', timeCalls(Reducers._median, int(repeat), data, axis=axis, weights=weights))
+
+
+def _applyStepwise(R, data, weights=None, dates=None):
+    # The former Reducers.apply: each reducer in turn on a full masked array
+    import Reducers
+    for r in R:
+        reducer, dim = Reducers.parse(r)
+        if reducer in Reducers.DATED_REDUCERS:
+            data = reducer(data, weights=weights, axis=dim, keepdims=True, dates=dates)
+        else:
+            data = reducer(data, weights=weights, axis=dim, keepdims=True)
+    return data
+
+
+def bench_reducers(bands=30, size=256, repeat=5):
+    # Every reducer over each dimension, plus common chains, on a (bands, size,
+    # size) int16 stack with 10% of values masked and weighted pixels: reducer
+    # by reducer on masked arrays vs. through Reducers' plans, which are fused
+    # (and use numexpr, if it's installed) where every step has a kernel.
+    import datetime
+    import Reducers
+    bands, size = int(bands), int(size)
+    shape = (bands, size, size)
+    data = np.ma.MaskedArray(np.random.randint(0, 500, shape).astype(np.int16), np.random.rand(*shape) < 0.1)
+    weights = np.random.rand(size, size)
+    dates = [datetime.date(1984+i, 8, 1) for i in range(bands)]
+
+    chains = [[d+r] for r in ('mean', 'std', 'var', 'sum', 'count', 'min', 'max', 'median', 'p95')
+                    for d in ('t_', 's_', '')]
+    chains += [['t_'+r] for r in ('slope', 'theilsen', 'change', 'breaks')]
+    chains += [['s_histogram'], ['t_mean', 's_max'], ['t_max', 's_mean'], ['t_slope', 's_mean']]
+
+    print('numexpr: {}'.format('yes' if Reducers.numexpr is not None else 'no'))
+    for R in chains:
+        label = '{} {}x{}x{}'.format(','.join(R), *shape)
+        report(label+', stepwise', timeCalls(_applyStepwise, int(repeat), R, data, weights, dates))
+        if Reducers.getPlan(R).fused:
+            report(label+', fused', timeCalls(Reducers.apply, int(repeat), R, data, weights, dates))
+
+
+BENCHMARKS = {
+    'tiles': bench_tiles,
+    'bands': bench_bands,
+    'render': bench_render,
+    'viewport': bench_viewport,
+    'scaling': bench_scaling,
+    'median': bench_median,
+    'reducers': bench_reducers,
+}
+
+if __name__ == '__main__':
+    BENCHMARKS[sys.argv[1]](*sys.argv[2:])
@@ -1,8 +1,17 @@
 import os, time
-import msgpack 
+import threading
+from collections import OrderedDict
+import msgpack
 from hashlib import sha1
 import functools
 import errno
+from contextlib import contextmanager
+
+# fcntl is only on Unix; without it, requests are coalesced within a process only
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
 
 def mkdirs_safe(path):
     try:
@@ -13,34 +22,449 @@ def mkdirs_safe(path):
         else:
             raise
 
+
+# Total bytes each cache may hold on disk before its least recently used
+# entries are evicted, down to CACHE_LOW_WATER of that
+CACHE_SIZE = 4 * 2**30
+CACHE_LOW_WATER = 0.9
+
+# Seconds between sweeps of a disk cache for its size. A sweep comes sooner
+# once this process has written the room between the cap and the low water mark.
+CACHE_SWEEP_INTERVAL = 300
+
+# Bytes of responses each in-memory cache may hold, per process
+MEMORY_CACHE_SIZE = 256 * 2**20
+
+# Seconds a request waits on an identical one in progress before doing the
+# work itself
+COALESCE_TIMEOUT = 10
+
+# Entries start with a byte saying how the rest is stored: strings, such as
+# tiles, as they are, so hits are served without unpacking them; anything
+# else as msgpack
+RAW = b'r'
+PACKED = b'm'
+
+
+def normalize(value):
+    # A canonical form of call arguments for cache keys. Mappings, including
+    # webob's request parameters, become dicts with lowercase keys; sequences
+    # become lists, and scalars strings, so 7 and '7' are the same request.
+    if hasattr(value, 'items'):
+        return {str(k).lower(): normalize(v) for k,v in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [normalize(v) for v in value]
+    if isinstance(value, float):
+        return repr(value)
+    if isinstance(value, unicode):
+        return value.encode('utf-8')
+    return str(value)
+
+
+def cacheKey(f, args, kwargs, version=None):
+    # Content addressed key of a call: the hash of its normalized arguments.
+    # version, if given, is called with the same arguments for a stamp of the
+    # data the call reads, e.g. the modification times of an asset's files, so
+    # responses made from older data are no longer found once it changes.
+    call = [f.__module__, f.__name__, list(args), kwargs]
+    if version is not None:
+        call.append(version(*args, **kwargs))
+    return sha1(msgpack.packb(normalize(call))).hexdigest()
+
+
+class DiskCache(object):
+    # Entries are files named by their key, sharded into two levels of
+    # directories by its first four hex digits so no directory grows too large.
+    # They're written to a temporary file and renamed into place, so readers
+    # never see partial entries, and hits update their access time, which
+    # orders eviction.
+    #
+    # Requests never measure the cache. A background thread in each process
+    # sweeps it every CACHE_SWEEP_INTERVAL seconds, or sooner when the process
+    # has written a lot, adding up what's on disk and evicting down to the low
+    # water mark when it's over the cap. Processes sharing the cache take turns
+    # through a lock file, and skip a sweep another one has just done, so the
+    # cap holds for all of them together.
+    def __init__(self, root, stale_seconds, max_bytes=CACHE_SIZE):
+        self.root = root
+        self.stale_seconds = stale_seconds
+        self.max_bytes = max_bytes
+        self.stats = {'hits': 0, 'misses': 0, 'stores': 0, 'evictions': 0, 'sweeps': 0}
+        self.size = None
+        self._written = 0
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._sweeper = None
+
+    def path(self, key):
+        return os.path.join(self.root, key[:2], key[2:4], key)
+
+    def count(self, stat, n=1):
+        with self._lock:
+            self.stats[stat] += n
+
+    def get(self, key):
+        # The cached value, or None on a miss
+        fn = self.path(key)
+        try:
+            st = os.stat(fn)
+            if time.time() - st.st_mtime >= self.stale_seconds:
+                raise OSError(errno.ESTALE, 'Stale cache entry')
+            with open(fn, 'rb') as f:
+                entry = f.read()
+            os.utime(fn, (time.time(), st.st_mtime))
+        except (IOError, OSError):
+            self.count('misses')
+            return None
+
+        self.count('hits')
+        if entry[:1] == RAW:
+            return entry[1:]
+        return msgpack.unpackb(entry[1:])
+
+    def put(self, key, value):
+        if isinstance(value, bytes):
+            entry = RAW + value
+        else:
+            try:
+                entry = PACKED + msgpack.packb(value)
+            except TypeError:
+                # Streams and other values that can't be stored
+                return
+
+        fn = self.path(key)
+        mkdirs_safe(os.path.dirname(fn))
+        tmp = '{}.{}.{}.tmp'.format(fn, os.getpid(), threading.current_thread().ident)
+        with open(tmp, 'wb') as f:
+            f.write(entry)
+        os.rename(tmp, fn)
+
+        with self._lock:
+            self.stats['stores'] += 1
+            self._written += len(entry)
+            if self._written > self.max_bytes * (1 - CACHE_LOW_WATER):
+                self._wake.set()
+        self.startSweeper()
+
+    def startSweeper(self):
+        # Threads don't survive a fork, so each process starts its own sweeper
+        # on its first store
+        sweeper = self._sweeper
+        if sweeper is not None and sweeper[0] == os.getpid():
+            return
+        with self._lock:
+            if self._sweeper is not sweeper:
+                return
+            thread = threading.Thread(target=self._sweep, name='cache-sweep')
+            thread.daemon = True
+            self._sweeper = (os.getpid(), thread)
+        thread.start()
+
+    def _sweep(self):
+        while True:
+            self._wake.wait(CACHE_SWEEP_INTERVAL)
+            self._wake.clear()
+            try:
+                self.sweep()
+            except Exception:
+                # A failed sweep is tried again next time; requests go on regardless
+                pass
+
+    def sweep(self, force=False):
+        # Measure the cache and evict from it if it's over the cap. Unless
+        # forced, skipped when another process is sweeping or swept less than
+        # CACHE_SWEEP_INTERVAL/2 seconds ago, unless this one has written a lot.
+        with self._lock:
+            written = self._written
+            self._written = 0
+        busy = written > self.max_bytes * (1 - CACHE_LOW_WATER)
+        mkdirs_safe(self.root)
+        with open(os.path.join(self.root, 'sweep.lock'), 'a') as f:
+            if fcntl is not None:
+                try:
+                    fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except IOError:
+                    return
+            try:
+                swept = os.fstat(f.fileno()).st_mtime
+                if not (force or busy) and time.time() - swept < CACHE_SWEEP_INTERVAL / 2.0:
+                    return
+                entries = list(self.entries())
+                size = sum(size for atime, size, fn in entries)
+                if size > self.max_bytes:
+                    size = self.evict(entries, int(self.max_bytes * CACHE_LOW_WATER))
+                self.size = size
+                self.count('sweeps')
+                os.utime(f.name, None)
+            finally:
+                if fcntl is not None:
+                    fcntl.flock(f, fcntl.LOCK_UN)
+
+    def entries(self):
+        # (access time, size, path) of every entry
+        for dirpath, dirnames, filenames in os.walk(self.root):
+            for name in filenames:
+                if name.endswith('.lock'):
+                    continue
+                fn = os.path.join(dirpath, name)
+                try:
+                    st = os.stat(fn)
+                except OSError:
+                    continue
+                yield (st.st_atime, st.st_size, fn)
+
+    def diskUsage(self):
+        return sum(size for atime, size, fn in self.entries())
+
+    def evict(self, entries, target):
+        # Remove the least recently used of entries until they fit in target
+        # bytes, and return the bytes left. Other processes may share the
+        # directory, so this goes by what's on disk rather than what this
+        # process has written.
+        entries = sorted(entries)
+        total = sum(size for atime, size, fn in entries)
+        for atime, size, fn in entries:
+            if total <= target:
+                break
+            try:
+                os.remove(fn)
+                self.count('evictions')
+            except OSError:
+                pass
+            total -= size
+        return total
+
+
+def sizeOf(value):
+    # Approximate bytes held by a response: strings, and dicts and lists of
+    # them. None for values that can't be cached in memory, such as streams.
+    if isinstance(value, basestring):
+        return len(value)
+    if isinstance(value, dict):
+        sizes = [sizeOf(k) for k in value] + [sizeOf(v) for v in value.values()]
+    elif isinstance(value, (list, tuple)):
+        sizes = [sizeOf(v) for v in value]
+    elif value is None or isinstance(value, (int, long, float, bool)):
+        return 8
+    else:
+        return None
+    return None if None in sizes else sum(sizes)
+
+
+class MemoryCache(object):
+    # A least recently used cache of responses in this process, bounded by
+    # their total size in bytes. Values are shared between callers, not copied.
+    def __init__(self, max_bytes=MEMORY_CACHE_SIZE):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.stats = {'hits': 0, 'misses': 0, 'stores': 0, 'evictions': 0}
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            try:
+                value, size = self._entries.pop(key)
+            except KeyError:
+                self.stats['misses'] += 1
+                return None
+            self._entries[key] = (value, size)
+            self.stats['hits'] += 1
+            return value
+
+    def put(self, key, value):
+        size = sizeOf(value)
+        if size is None or size > self.max_bytes:
+            return
+
+        with self._lock:
+            if key in self._entries:
+                self.size -= self._entries.pop(key)[1]
+            self._entries[key] = (value, size)
+            self.size += size
+            self.stats['stores'] += 1
+            while self.size > self.max_bytes:
+                oldKey, (oldValue, oldSize) = self._entries.popitem(last=False)
+                self.size -= oldSize
+                self.stats['evictions'] += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.size = 0
+
+
+class Flight(object):
+    # A call in progress, which identical calls wait on
+    def __init__(self):
+        self.done = threading.Event()
+        self.ok = False
+        self.result = None
+
+
+class SingleFlight(object):
+    # Runs concurrent identical calls once. Within a process, the first call for
+    # a key leads and later ones wait on it and share its result. Leaders in
+    # different processes lock a byte of a file under lock_root, at an offset
+    # given by the key, so one of them works while the others wait for the
+    # lock; they then find its result in the disk cache below. These are POSIX
+    # record locks, which only keep out other processes, and only those after
+    # the same byte, so leaders of other keys never wait on each other.
+    def __init__(self, lock_root=None, timeout=COALESCE_TIMEOUT):
+        self.lock_root = lock_root
+        self.timeout = timeout
+        self.stats = {'leaders': 0, 'followers': 0, 'timeouts': 0}
+        self._flights = {}
+        self._lock = threading.Lock()
+        self._file = None
+        if lock_root is not None:
+            mkdirs_safe(lock_root)
+
+    def count(self, stat):
+        with self._lock:
+            self.stats[stat] += 1
+
+    def do(self, key, call):
+        with self._lock:
+            flight = self._flights.get(key)
+            leader = flight is None
+            if leader:
+                flight = self._flights[key] = Flight()
+            self.stats['leaders' if leader else 'followers'] += 1
+
+        if not leader:
+            if not flight.done.wait(self.timeout):
+                self.count('timeouts')
+            elif flight.ok and sizeOf(flight.result) is not None:
+                return flight.result
+            # The leader failed, is taking too long, or returned a stream
+            # that can't be shared; do it ourselves
+            return call()
+
+        try:
+            with self.processLock(key):
+                flight.result = call()
+                flight.ok = True
+            return flight.result
+        finally:
+            with self._lock:
+                del self._flights[key]
+            flight.done.set()
+
+    def lockFile(self):
+        # Closing any descriptor of a file drops all of the process's record
+        # locks on it, so the process's threads share one that's never closed
+        with self._lock:
+            if self._file is None:
+                self._file = open(os.path.join(self.lock_root, 'flights.lock'), 'a')
+            return self._file
+
+    @contextmanager
+    def processLock(self, key):
+        if fcntl is None or self.lock_root is None:
+            yield
+            return
+
+        # Locks can't time out, so poll for the lock until the timeout passes,
+        # then go ahead without it
+        f = self.lockFile()
+        offset = int(key[:12], 16)
+        deadline = time.time() + self.timeout
+        locked = False
+        while not locked:
+            try:
+                fcntl.lockf(f, fcntl.LOCK_EX | fcntl.LOCK_NB, 1, offset)
+                locked = True
+            except IOError as exc:
+                if exc.errno not in (errno.EAGAIN, errno.EACCES) or time.time() > deadline:
+                    self.count('timeouts')
+                    break
+                time.sleep(0.01)
+        try:
+            yield
+        finally:
+            if locked:
+                fcntl.lockf(f, fcntl.LOCK_UN, 1, offset)
+
+
+# The caches made by the decorators, by function name and tier, for stats()
+CACHES = {}
+
+def stats():
+    # Hit, miss, store and eviction counts of this process's caches
+    return {name: {tier: dict(c.stats) for tier, c in tiers.items()}
+                for name, tiers in CACHES.items()}
+
+
 # Defaults to 15 days (1,296,000 sec)
-def cache_disk(cache_root="/tmp/cachepy", stale_seconds = 1296000):
+def cache_disk(cache_root="/tmp/cachepy", stale_seconds = 1296000, max_bytes=CACHE_SIZE, version=None):
     def doCache(f):
-        #@functools.wraps(f)
+        cache = DiskCache(os.path.join(cache_root, f.__name__), stale_seconds, max_bytes)
+        CACHES.setdefault(f.__name__, {})['disk'] = cache
+
+        @functools.wraps(f)
         def inner_function(*args, **kwargs):
-            # calculate a cache key based on the decorated method signature
-            key = sha1(msgpack.packb((f.__module__, f.__name__, args, kwargs))).hexdigest()
-            
-            # Make sure the cach path exists
-            cache_path = os.path.join(cache_root, f.__name__)
-            mkdirs_safe(cache_path)
-            fn = os.path.join(cache_path, key)
-
-            # Check if the cached object exists and is fresh
-            if os.path.exists(fn):
-                modified = os.path.getmtime(fn)
-                age_seconds = time.time() - modified
-                if age_seconds < stale_seconds:
-                    return msgpack.unpackb(open(fn, "rb").read())
-
-            # Otherwise call the decorated function
+            key = cacheKey(f, args, kwargs, version)
+            result = cache.get(key)
+            if result is not None:
+                return result
+
+            # Otherwise call the decorated function, and save the result for next time
             result = f(*args, **kwargs)
+            cache.put(key, result)
+            return result
+
+        inner_function.cache = cache
+        inner_function.uncached = f
+        return inner_function
+    return doCache
 
-            # Save the cached object for next time
-            with open(fn, 'wb+') as cachefile:
-                cachefile.write(msgpack.packb(result))
 
+# Goes above cache_disk, so hot responses are served without touching the disk.
+# Each tier is given the same version function, if any:
+#
+#   @cache_memory(version=tileVersion)
+#   @cache_disk(CACHE_PATH, version=tileVersion)
+#   def parseTileRequest(...):
+def cache_memory(max_bytes=MEMORY_CACHE_SIZE, version=None):
+    def doCache(f):
+        cache = MemoryCache(max_bytes)
+        CACHES.setdefault(f.__name__, {})['memory'] = cache
+
+        @functools.wraps(f)
+        def inner_function(*args, **kwargs):
+            key = cacheKey(f, args, kwargs, version)
+            result = cache.get(key)
+            if result is not None:
+                return result
+
+            result = f(*args, **kwargs)
+            cache.put(key, result)
             return result
+
+        inner_function.cache = cache
+        inner_function.uncached = getattr(f, 'uncached', f)
         return inner_function
     return doCache
-    
\ No newline at end of file
+
+
+# Goes between cache_memory and cache_disk, so concurrent identical requests
+# are rendered once and everyone else is served from the caches:
+#
+#   @cache_memory(version=tileVersion)
+#   @coalesce(CACHE_PATH, version=tileVersion)
+#   @cache_disk(CACHE_PATH, version=tileVersion)
+#   def parseTileRequest(...):
+def coalesce(cache_root="/tmp/cachepy", timeout=COALESCE_TIMEOUT, version=None):
+    def doCoalesce(f):
+        flights = SingleFlight(os.path.join(cache_root, 'locks', f.__name__), timeout)
+        CACHES.setdefault(f.__name__, {})['coalesce'] = flights
+
+        @functools.wraps(f)
+        def inner_function(*args, **kwargs):
+            return flights.do(cacheKey(f, args, kwargs, version), lambda: f(*args, **kwargs))
+
+        inner_function.cache = flights
+        inner_function.uncached = getattr(f, 'uncached', f)
+        return inner_function
+    return doCoalesce
@@ -0,0 +1,75 @@
+import datetime
+import calendar
+from email.utils import formatdate
+from hashlib import sha1
+import msgpack
+
+from cache import normalize
+from Asset import assetFiles, modifiedTimes
+
+# HTTP validators and lifetimes for responses, so browsers and CDNs keep
+# what they've downloaded and only ask whether it has changed.
+#
+# Responses about an asset get an ETag from the modification times of its VRT
+# and YAML files and the normalized request, so they're validated without
+# rendering anything, and change whenever the asset does. The response caches
+# and the tile store are keyed by the same times, so the bodies served with
+# those validators are of that version too. If the asset changes while a
+# response is being made, it's sent without validators. Other responses get
+# an ETag from a hash of their body, and streams get none.
+
+# Seconds clients may reuse a tile of a specific date without asking, and
+# anything else before asking whether it has changed
+TILE_MAX_AGE = 30 * 24 * 3600
+DATA_MAX_AGE = 3600
+
+
+def isDated(date):
+    # Whether a band_or_date is a single date, rather than e.g. a band number
+    try:
+        datetime.datetime.strptime(str(date), '%Y-%m-%d')
+        return True
+    except ValueError:
+        return False
+
+
+def assetValidators(asset, request, stamp=None):
+    # (ETag, Last-Modified seconds) of a request about an asset, or (None, None)
+    # if the asset doesn't exist. stamp is the modification times of the
+    # asset's files, if they've been looked up already; responses are cached
+    # by the same stamp, so a body and its validators are of the same version.
+    if stamp is None:
+        stamp = modifiedTimes(assetFiles(asset))
+    if stamp[0] is None:
+        return None, None
+    etag = sha1(msgpack.packb(normalize([asset, stamp, request]))).hexdigest()
+    return '"{}"'.format(etag), int(max(t for t in stamp if t is not None))
+
+
+def bodyValidators(body):
+    # (ETag, Last-Modified seconds) of a response that isn't about an asset
+    return '"{}"'.format(sha1(body).hexdigest()), None
+
+
+def notModified(request, etag, modified):
+    # Whether the client's copy, from the webob request's conditional
+    # headers, is still current. If-None-Match wins over If-Modified-Since.
+    if etag is not None and request.if_none_match:
+        return etag.strip('"') in request.if_none_match
+    if modified is not None and request.if_modified_since:
+        return modified <= calendar.timegm(request.if_modified_since.utctimetuple())
+    return False
+
+
+def setHeaders(response, etag, modified, maxAge):
+    if etag is not None:
+        response.headers['ETag'] = etag
+    if modified is not None:
+        response.headers['Last-Modified'] = formatdate(modified, usegmt=True)
+    response.headers['Cache-Control'] = 'public, max-age={}'.format(maxAge)
+
+
+def respondNotModified(response, etag, modified, maxAge):
+    # 304s carry the validators and lifetime, but no body
+    response.set_status(304)
+    setHeaders(response, etag, modified, maxAge)
@@ -7,10 +7,12 @@ if 'GDAL_DATA' not in os.environ:
 import gdal, ogr, osr
 
 import SpatialReference
+import tms
 from Region import Region
-from Asset import Asset, ListAssets
+from Asset import getAsset, ListAssets
 import Reducers
 import Outputs
+import cache
 
 gdal.UseExceptions()
 ogr.UseExceptions()
@@ -19,6 +21,7 @@ osr.UseExceptions()
 
 # Some Constants
 URL_BASE = 'http://ltweb.ceoas.oregonstate.edu/mapping/'
+MAX_BATCH_TILES = 64
 
 
     
@@ -32,7 +35,8 @@ def op_list(output='yaml', **kwargs):
 # Get metadata about asset
 def op_info(asset, output='yaml', **kwargs):
     outputDriver = Outputs.getDriver(output)
-    info = Asset(asset).metadata
+    # Copy, since pooled assets share their metadata between requests
+    info = dict(getAsset(asset).metadata)
 
     # Only yaml natively serializes datetime objects
     if output.lower() != 'yaml':
@@ -40,28 +44,121 @@ def op_info(asset, output='yaml', **kwargs):
             info['band-dates'] = {k:v.isoformat() for k,v in info['band-dates'].iteritems()}
     return outputDriver(info)
 
+# Hit, miss and eviction counts of the response caches in this process,
+# and the counts of tiles its render pool has worked through
+def op_stats(output='yaml', **kwargs):
+    # renderer imports this module, so it's imported here
+    import renderer
+    outputDriver = Outputs.getDriver(output)
+    stats = cache.stats()
+    stats['render'] = renderer.stats()
+    return outputDriver(stats)
+    
+
 def op_icon(asset, **kwargs):
-    with open(Asset(asset).getIconFilename(), 'rb') as infile:
+    with open(getAsset(asset).getIconFilename(), 'rb') as infile:
         icon = infile.read()
     return icon
 
 
-def op_window(asset, window, window_size, date,  srs=None, output='png', srs_type='unknown', resample=None, reducers=None, **kwargs):
+def _isTrue(value):
+    # Flags may come from query strings as well as JSON or YAML
+    if isinstance(value, basestring):
+        return value.lower() in ('1', 'true', 'yes', 'on')
+    return bool(value)
+    
+    
+def _streamBlocks(blocks, count, reducers, weights=None, dates=None):
+    # Reduce streamed blocks of bands as they come, when reducers work on each
+    # band alone. Otherwise they're reduced together, before anything is sent.
+    # Returns the blocks and the number of rows (bands, or e.g. the histogram
+    # of each band) they add up to.
+    if not reducers:
+        return blocks, count
+    if Reducers.isBandwise(reducers):
+        return (Reducers.apply(reducers, block, weights) for block in blocks), count
+    result = Reducers.reduceBlocks(reducers, blocks, weights, dates)
+    return [result], len(result)
+    
+    
+def op_window(asset, window, window_size, date,  srs=None, output='png', srs_type='unknown', resample=None, reducers=None, compression=None, mode=None, quality=None, stream=False, **kwargs):
     
     outputDriver = Outputs.getDriver(output)
     
-    DS = Asset(asset)
+    DS = getAsset(asset)
     if srs:
         SR = SpatialReference.parse(srs, srs_type)
         DS = DS.warpTo(SR, resample)
-    data = DS.getWindow(window, date, window_size, resample)
+    
+    # With stream set, send the result a block of bands at a time, when the
+    # output can be streamed (see Outputs.STREAM_DRIVERS); otherwise it's
+    # made whole, below
+    streamDriver = Outputs.getStreamDriver(output) if _isTrue(stream) else None
+    if streamDriver:
+        bands = DS.selectBands(date)
+        blocks, count = _streamBlocks(DS.iterWindow(window, date, window_size, resample),
+                                      len(bands), reducers, dates=DS.getBandDates(bands))
+        return streamDriver(blocks, count, ds=DS)
+    
+    # Reduce the window a block of bands at a time, so long time series are
+    # never in memory all at once
     if reducers:
-        data = Reducers.apply(reducers, data)
+        data = Reducers.reduceBlocks(reducers, DS.iterWindow(window, date, window_size, resample),
+                                     dates=DS.getBandDates(DS.selectBands(date)))
+    else:
+        data = DS.getWindow(window, date, window_size, resample)
     
-    return outputDriver(data, ds=DS)
+    return outputDriver(data, ds=DS, compression=compression, mode=mode, quality=quality)
     
 
-def op_regions(asset, region, output='json', date=None,  srs=None, srs_type='unknown', resample=None, region_srs=None, region_srs_type='unknown', reducers=None, region_type='json', **kwargs):
+def _tileSpan(t):
+    # A tile index, or an inclusive range of them as 'first-last' or [first, last]
+    if isinstance(t, basestring):
+        t = t.split('-')
+    if not hasattr(t, '__iter__'):
+        t = [t]
+    t = [int(i) for i in t]
+    return t[0], t[-1]
+    
+    
+def op_tiles(asset, date, zoom, x, y, resample=None, reducers=None, compression='fast', **kwargs):
+    # Render a block of neighbouring TMS tiles, e.g. a viewport, from a single read
+    # and warp of the window they cover. Returns a msgpack map of 'zoom/x/y' to PNG.
+    x0, x1 = _tileSpan(x)
+    y0, y1 = _tileSpan(y)
+    nx, ny = x1-x0+1, y1-y0+1
+    if nx < 1 or ny < 1 or nx*ny > MAX_BATCH_TILES:
+        raise ValueError('Batches must have between 1 and {} tiles'.format(MAX_BATCH_TILES))
+    
+    # Tile rows run from north to south, like the window's rows
+    xmin, ymin = tms.tileBounds(x0, y1, zoom)[:2]
+    xmax, ymax = tms.tileBounds(x1, y0, zoom)[2:]
+    size = tms.TILE_SIZE
+    
+    DS = getAsset(asset).warpTo(tms.TMS_SRS, resample)
+    data = DS.getWindow((xmin, ymin, xmax, ymax), date, [nx*size, ny*size], resample)
+    
+    # Reducers over time give each pixel the same value however the window is
+    # cut, so they reduce the whole batch at once. Any others, e.g. over space,
+    # must only see one tile's pixels, so they reduce each tile on its own.
+    dates = DS.getBandDates(DS.selectBands(date)) if reducers else None
+    pixelwise = not reducers or Reducers.isPixelwise(reducers)
+    if reducers and pixelwise:
+        data = Reducers.apply(reducers, data, dates=dates)
+    
+    toPNG = Outputs.getDriver('png')
+    tiles = {}
+    for i in range(nx):
+        for j in range(ny):
+            tile = data[:, j*size:(j+1)*size, i*size:(i+1)*size]
+            if not pixelwise:
+                tile = Reducers.apply(reducers, tile, dates=dates)
+            tiles['{}/{}/{}'.format(zoom, x0+i, y0+j)] = toPNG(tile, ds=DS, compression=compression)
+    
+    return Outputs.toMsgPack(tiles)
+    
+    
+def op_regions(asset, region, output='json', date=None,  srs=None, srs_type='unknown', resample=None, region_srs=None, region_srs_type='unknown', reducers=None, region_type='json', stream=False, **kwargs):
     
     outputDriver = Outputs.getDriver(output)
     
@@ -71,28 +168,42 @@ def op_regions(asset, region, output='json', date=None,  srs=None, srs_type='unk
         region_SR = SpatialReference.parse(region_srs, region_srs_type)
         R.geom.AssignSpatialReference(region_SR)
     
-    DS = Asset(asset)
+    DS = getAsset(asset)
     if srs:
         SR = SpatialReference.parse(srs, srs_type)
         DS = DS.warpTo(SR, resample)
     
-    data,weights = DS.getRegion(R, date, resample)
-
+    # Streamed like op_window's
+    streamDriver = Outputs.getStreamDriver(output) if _isTrue(stream) else None
+    if streamDriver:
+        blocks, weights = DS.iterRegion(R, date, resample)
+        bands = DS.regionBands(date)
+        blocks, count = _streamBlocks(blocks, len(bands), reducers, weights, DS.getBandDates(bands))
+        return streamDriver(blocks, count, ds=DS)
+    
     if reducers:
-        data = Reducers.apply(reducers, data, weights)
-    data = data.tolist()
+        blocks, weights = DS.iterRegion(R, date, resample)
+        data = Reducers.reduceBlocks(reducers, blocks, weights, DS.getBandDates(DS.regionBands(date)))
+    else:
+        data,weights = DS.getRegion(R, date, resample)
+    
+    # Drivers get the masked array itself; only the text ones make lists of it
     return outputDriver(data, ds=DS)
     
     
     
 OPERATIONS = {
         'window': op_window,
+        'tiles': op_tiles,
         'regions': op_regions,
         'list': op_list,
         'info': op_info,
-        'icon': op_icon
+        'icon': op_icon,
+        'stats': op_stats
     }
 def dispatch(call):
+    # Returns a string, or, for calls with 'stream' set and an output that
+    # can stream, a generator of strings to be written out as they come
 
     return OPERATIONS[call['operation']](**call)
 
@@ -0,0 +1,62 @@
+from __future__ import print_function
+# Builds missing overviews for the source rasters of every asset, so low zoom
+# windows can be read from a coarser level instead of the full resolution:
+#
+#   python overviews.py [asset ...]
+#
+# Overviews are written next to each source as external .ovr files, using the
+# asset's 'resample-method'. Sources that already have overviews are skipped.
+
+import os, sys
+
+if 'GDAL_DATA' not in os.environ:
+    os.environ['GDAL_DATA'] = r'/usr/lib/anaconda/share/gdal'
+from osgeo import gdal
+
+from Asset import Asset, ListAssets
+
+gdal.UseExceptions()
+gdal.SetConfigOption('COMPRESS_OVERVIEW', 'DEFLATE')
+
+# Keep halving until the coarsest overview is about one tile across
+MIN_OVERVIEW_SIZE = 256
+
+
+def overviewFactors(xsize, ysize):
+    factors = []
+    f = 2
+    while min(xsize, ysize) / f >= MIN_OVERVIEW_SIZE:
+        factors.append(f)
+        f *= 2
+    return factors
+
+
+def sourceFiles(asset):
+    # The raster files an asset's VRT refers to (the first entry is the VRT itself)
+    return [fn for fn in asset.ds.GetFileList()[1:] if not fn.endswith('.ovr')]
+
+
+def buildOverviews(fn, resampleMethod='nearest'):
+    # Returns True if overviews were built, False if there already were some
+    ds = gdal.Open(fn)
+    if ds.GetRasterBand(1).GetOverviewCount() > 0:
+        return False
+
+    factors = overviewFactors(ds.RasterXSize, ds.RasterYSize)
+    if factors:
+        ds.BuildOverviews(resampleMethod.upper(), factors)
+    ds = None
+    return bool(factors)
+
+
+def buildAssetOverviews(name):
+    asset = Asset(name)
+    resampleMethod = asset.metadata.get('resample-method', 'nearest')
+    for fn in sourceFiles(asset):
+        if buildOverviews(fn, resampleMethod):
+            print('{}: built overviews for {}'.format(name, fn))
+
+
+if __name__ == '__main__':
+    for name in (sys.argv[1:] or ListAssets()):
+        buildAssetOverviews(name)
@@ -1,37 +1,166 @@
 import zlib, struct
 import numpy as np
-            
-def Build(image_data, palette=None):
-    
-    def png_pack(head, data):
-        chunk = head + data
-        return (struct.pack("!I", len(data)) +
-                chunk +
-                struct.pack("!I", 0xFFFFFFFF & zlib.crc32(chunk)))
+
+# Named compression settings, as (zlib level, filter): fast for tiles rendered
+# live, best for tiles rendered ahead of time into the pyramid store
+COMPRESSION = {
+    'fast': (1, 'up'),
+    'default': (6, 'adaptive'),
+    'best': (9, 'adaptive')
+    }
+
+FILTER_TYPES = {'none': 0, 'sub': 1, 'up': 2, 'average': 3, 'paeth': 4}
+
+
+def getCompression(compression=None):
+    # (zlib level, filter) from a named setting or a zlib level
+    if compression is None:
+        compression = 'default'
+    try:
+        return COMPRESSION[str(compression).lower()]
+    except KeyError:
+        return (min(max(int(compression), 0), 9), 'adaptive')
+
+
+def png_pack(head, data):
+    chunk = head + data
+    return (struct.pack("!I", len(data)) +
+            chunk +
+            struct.pack("!I", 0xFFFFFFFF & zlib.crc32(chunk)))
+
+
+def packBits(image_data, bit_depth):
+    # Pack rows of values below 2**bit_depth into bytes, several pixels per byte
+    height, width = image_data.shape
+    per_byte = 8 // bit_depth
+    stride = -(-width // per_byte)
+
+    pixels = np.zeros((height, stride*per_byte), np.uint8)
+    pixels[:,:width] = image_data
+    pixels = pixels.reshape((height, stride, per_byte))
+
+    rows = np.zeros((height, stride), np.uint8)
+    for i in range(per_byte):
+        rows |= pixels[:,:,i] << (8 - bit_depth*(i+1))
+    return rows
+
+
+def filterRows(rows, bpp, filter='adaptive', out=None):
+    # Apply PNG filters to rows of bytes, with bpp bytes per pixel, into `out`,
+    # which has a leading column for each row's filter type. The adaptive filter
+    # picks the filter for each row with the smallest sum of absolute differences.
+    height, stride = rows.shape
+    if out is None:
+        out = np.empty((height, stride+1), np.uint8)
+
+    if filter == 'none':
+        out[:,0] = 0
+        out[:,1:] = rows
+        return out
+
+    # The bytes to the left (a), above (b) and above-left (c) of each byte
+    a = np.zeros_like(rows); a[:,bpp:] = rows[:,:-bpp]
+    b = np.zeros_like(rows); b[1:,:] = rows[:-1,:]
+
+    def predict(t):
+        if t == 1:
+            return a
+        if t == 2:
+            return b
+        if t == 3:
+            return ((a.astype(np.uint16) + b) >> 1).astype(np.uint8)
+        c = np.zeros_like(rows); c[1:,bpp:] = rows[:-1,:-bpp]
+        a16, b16, c16 = a.astype(np.int16), b.astype(np.int16), c.astype(np.int16)
+        pa = np.abs(b16 - c16)
+        pb = np.abs(a16 - c16)
+        pc = np.abs(a16 + b16 - 2*c16)
+        return np.where((pa <= pb) & (pa <= pc), a, np.where(pb <= pc, b, c))
+
+    if filter != 'adaptive':
+        t = FILTER_TYPES[filter]
+        out[:,0] = t
+        np.subtract(rows, predict(t), out=out[:,1:])
+        return out
+
+    # Bytes wrap around, so the filtered values are differences modulo 256
+    candidates = [rows] + [rows - predict(t) for t in (1, 2, 3, 4)]
+    cost = np.array([np.abs(f.view(np.int8).astype(np.int32)).sum(axis=1) for f in candidates])
+    choice = np.argmin(cost, axis=0)
+
+    out[:,0] = choice
+    for t, f in enumerate(candidates):
+        selected = (choice == t)
+        if selected.any():
+            out[selected,1:] = f[selected]
+    return out
+
+
+# PNG color types by the number of channels of an image
+COLOR_TYPES = {1: 0, 2: 4, 3: 2, 4: 6}
+
+
+def Build(image_data, palette=None, level=6, filter='adaptive', transparent=0):
+    # image_data is (height, width) for grayscale or palette images, or
+    # (height, width, channels) for gray+alpha, RGB or RGBA. 16 bit images
+    # are written from uint16 data, 8 bit ones from anything else. For
+    # grayscale, `transparent` is the value drawn as transparent, if any.
+
+    height, width = image_data.shape[:2]
+    channels = image_data.shape[2] if image_data.ndim == 3 else 1
+    bit_depth = 16 if image_data.dtype == np.uint16 else 8
 
     if palette is None:
-        color_type = 0
-        transparent = b'\x00\x00'
-        pal = ''
+        color_type = COLOR_TYPES[channels]
+        pal = b''
+        if color_type == 0 and transparent is not None:
+            trns = png_pack(b'tRNS', struct.pack('!H', int(transparent) & 0xFFFF))
+        else:
+            trns = b''
     else:
         color_type = 3
+        palette = np.asarray(palette)
+
+        # Small palettes are written with fewer bits per pixel
+        bit_depth = 8
+        for depth in (1, 2, 4):
+            if len(palette) <= 2**depth:
+                bit_depth = depth
+                break
+
         pal = png_pack(b'PLTE', b''.join([struct.pack('!3B', 0xFF & b>>16, 0xFF & b>>8, 0xFF & b) for b in palette]))
         if np.any(palette>=16777216):
-            transparent = b''.join([struct.pack('!B', 255-(0xFF & b>>24)) for b in palette])
+            trns = png_pack(b'tRNS', b''.join([struct.pack('!B', 255-(0xFF & b>>24)) for b in palette]))
         else:
-            transparent = b'\x00'
+            trns = png_pack(b'tRNS', b'\x00')
 
-    height, width = image_data.shape
-    
-    # Prepend each scan line with 0 for the filter type
-    scan = np.zeros((height, width+1), np.uint8)
-    scan[:,1:] = image_data;
-    raw = scan.tobytes()
+    # Rows of bytes, and the number of bytes in each pixel
+    if bit_depth < 8:
+        rows = packBits(image_data, bit_depth)
+        bpp = 1
+    elif bit_depth == 16:
+        rows = image_data.astype('>u2').view(np.uint8).reshape((height, -1))
+        bpp = 2*channels
+    else:
+        rows = image_data.astype(np.uint8, copy=False).reshape((height, -1))
+        bpp = channels
+
+    # Filter the scan lines straight into the buffer that gets compressed,
+    # each one prefixed by its filter type
+    raw = filterRows(rows, bpp, filter)
 
     return b''.join([
         b'\x89PNG\r\n\x1a\n',
-        png_pack(b'IHDR', struct.pack("!2I5B", width, height, 8, color_type, 0, 0, 0)),
+        png_pack(b'IHDR', struct.pack("!2I5B", width, height, bit_depth, color_type, 0, 0, 0)),
         pal,
-        png_pack(b'tRNS', transparent),
-        png_pack(b'IDAT', zlib.compress(raw)),
+        trns,
+        png_pack(b'IDAT', zlib.compress(raw, level)),
         png_pack(b'IEND', b'')])
+
+
+# Fully transparent images, encoded once for each size they're asked for
+_BLANK = {}
+
+def Blank(width, height):
+    if (width, height) not in _BLANK:
+        _BLANK[(width, height)] = Build(np.zeros((height, width), np.uint8), level=9)
+    return _BLANK[(width, height)]
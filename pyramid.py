@@ -0,0 +1,110 @@
+from __future__ import print_function
+# Pre-renders a Web Mercator tile pyramid for an asset, through the same
+# op_window pipeline as live tiles, into a tile store on disk:
+#
+#   python pyramid.py <asset> <band_or_date> <min zoom> <max zoom> [processes]
+#
+# Tiles are rendered in parallel across processes. Tiles already in the store
+# are skipped, so an interrupted build resumes when it's run again, unless the
+# asset has changed since they were rendered.
+
+import os, sys
+import multiprocessing as MP
+
+import tms
+from cache import mkdirs_safe
+
+TILE_STORE_PATH = '/data/tiles/'
+
+
+def tilePath(asset, date, zoom, x, y):
+    return os.path.join(TILE_STORE_PATH, asset, date, str(zoom), str(x), str(y)+'.png')
+
+
+def isCurrent(fn, stamp):
+    # Whether a stored tile was rendered after the asset's files were last
+    # changed, given their modification times (as from Asset.modifiedTimes)
+    try:
+        rendered = os.path.getmtime(fn)
+    except OSError:
+        return False
+    return all(t is None or t <= rendered for t in stamp)
+
+
+def readTile(asset, date, zoom, x, y, stamp=None):
+    # Returns the pre-rendered tile, or None if it isn't in the store, or,
+    # given the asset's stamp, was rendered from an older version of it
+    fn = tilePath(asset, date, zoom, x, y)
+    if stamp is not None and not isCurrent(fn, stamp):
+        return None
+    try:
+        with open(fn, 'rb') as f:
+            return f.read()
+    except IOError:
+        return None
+
+
+def writeTile(tile, asset, date, zoom, x, y):
+    fn = tilePath(asset, date, zoom, x, y)
+    mkdirs_safe(os.path.dirname(fn))
+
+    # Write to a temporary file and rename it into place, so an
+    # interrupted build never leaves a partial tile in the store
+    tmp = '{}.{}.tmp'.format(fn, os.getpid())
+    with open(tmp, 'wb') as f:
+        f.write(tile)
+    os.rename(tmp, fn)
+
+
+def pyramidTiles(asset, date, minZoom, maxZoom):
+    # Every tile covering the asset's extent, from the lowest zoom up
+    from Asset import getAsset
+    extent = getAsset(asset).getExtent(tms.TMS_SRS)
+
+    for zoom in range(int(minZoom), int(maxZoom)+1):
+        xmin, ymin, xmax, ymax = tms.tileRange(extent, zoom)
+        for x in range(xmin, xmax+1):
+            for y in range(ymin, ymax+1):
+                yield (asset, date, zoom, x, y)
+
+
+def _initWorker():
+    # GDAL handles inherited from the parent process can't be shared with it
+    from Asset import ASSET_POOL
+    ASSET_POOL.clear()
+
+
+def _renderTile(tile):
+    from operations import dispatch
+    # Tiles are rendered once and served many times, so compress them as much as possible
+    writeTile(dispatch(tms.tileCommand(*tile, compression='best')), *tile)
+    return tile
+
+
+def buildPyramid(asset, date, minZoom, maxZoom, processes=None):
+    # Tiles rendered before the asset last changed are rendered again
+    from Asset import assetFiles, modifiedTimes
+    stamp = modifiedTimes(assetFiles(asset))
+    tiles = [t for t in pyramidTiles(asset, date, minZoom, maxZoom)
+                if not isCurrent(tilePath(*t), stamp)]
+    print('{} tiles to render'.format(len(tiles)))
+
+    pool = MP.Pool(processes, initializer=_initWorker)
+    try:
+        for n, tile in enumerate(pool.imap_unordered(_renderTile, tiles, chunksize=16)):
+            if (n+1) % 1000 == 0:
+                print('{} of {} tiles rendered'.format(n+1, len(tiles)))
+    except:
+        # Stop at once; whatever was finished stays in the store
+        pool.terminate()
+        raise
+    else:
+        pool.close()
+    finally:
+        pool.join()
+
+
+if __name__ == '__main__':
+    asset, date, minZoom, maxZoom = sys.argv[1:5]
+    processes = int(sys.argv[5]) if len(sys.argv) > 5 else None
+    buildPyramid(asset, date, int(minZoom), int(maxZoom), processes)
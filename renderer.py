@@ -0,0 +1,120 @@
+import threading, time
+try:
+    import Queue as queue
+except ImportError:
+    import queue
+
+from operations import dispatch
+
+# A fixed pool of worker threads rendering API calls through operations.dispatch.
+# GDAL releases the GIL while it reads and warps, so threads render in parallel
+# without forking a process per call, and without SIGALRM (which only works in
+# the main thread).
+#
+# Every job has a deadline. Callers stop waiting when it passes, and workers
+# drop jobs that are cancelled or already past it instead of rendering them.
+# A render that has started can't be interrupted; its result is discarded.
+# The queue is bounded, and jobs that don't fit are refused right away, so
+# an overloaded server sheds load instead of queueing work it can't finish.
+
+RENDER_THREADS = 8
+RENDER_QUEUE_SIZE = 64
+RENDER_DEADLINE = 5
+
+
+class Overloaded(Exception):
+    """Raised when the render queue is full."""
+
+class DeadlineExceeded(Exception):
+    """Raised when a job hasn't finished by its deadline."""
+
+
+class RenderJob(object):
+    def __init__(self, call, deadline):
+        self.call = call
+        self.deadline = deadline
+        self.cancelled = False
+        self.result = None
+        self.error = None
+        self.done = threading.Event()
+
+    def cancel(self):
+        self.cancelled = True
+
+    def wait(self):
+        remaining = self.deadline - time.time()
+        if remaining <= 0 or not self.done.wait(remaining):
+            self.cancel()
+            raise DeadlineExceeded()
+        if self.error is not None:
+            raise self.error
+        return self.result
+
+
+class RenderPool(object):
+    def __init__(self, threads=RENDER_THREADS, queueSize=RENDER_QUEUE_SIZE, render=dispatch):
+        self.render = render
+        self.queue = queue.Queue(queueSize)
+        self.stats = {'rendered': 0, 'failed': 0, 'expired': 0, 'shed': 0}
+        self.lock = threading.Lock()
+        self.workers = []
+        for i in range(threads):
+            worker = threading.Thread(target=self._work, name='render-%d' % i)
+            worker.daemon = True
+            worker.start()
+            self.workers.append(worker)
+
+    def submit(self, call, timeout=RENDER_DEADLINE):
+        job = RenderJob(call, time.time() + timeout)
+        try:
+            self.queue.put_nowait(job)
+        except queue.Full:
+            self.count('shed')
+            raise Overloaded()
+        return job
+
+    def __call__(self, call, timeout=RENDER_DEADLINE):
+        # Render a call, waiting at most `timeout` seconds for it
+        return self.submit(call, timeout).wait()
+
+    def count(self, stat):
+        # Workers and request threads update the stats concurrently
+        with self.lock:
+            self.stats[stat] += 1
+
+    def _work(self):
+        while True:
+            job = self.queue.get()
+            if job.cancelled or time.time() > job.deadline:
+                self.count('expired')
+            else:
+                try:
+                    job.result = self.render(job.call)
+                    self.count('rendered')
+                except Exception as e:
+                    job.error = e
+                    self.count('failed')
+            job.done.set()
+
+
+# The pool is started on first use, so that the threads belong to the
+# process serving requests rather than to a parent it was forked from.
+_POOL = None
+_POOL_LOCK = threading.Lock()
+
+def getPool():
+    global _POOL
+    with _POOL_LOCK:
+        if _POOL is None:
+            _POOL = RenderPool()
+    return _POOL
+
+def render(call, timeout=RENDER_DEADLINE):
+    return getPool()(call, timeout)
+
+def stats():
+    # Counts of the jobs this process's pool has rendered, failed, let expire and shed
+    if _POOL is None:
+        return {}
+    with _POOL.lock:
+        return dict(_POOL.stats)
@@ -0,0 +1,92 @@
+import os, shutil, tempfile
+import unittest
+import numpy as np
+import msgpack
+from osgeo import gdal
+
+import Asset
+import operations
+import Outputs
+
+
+def maskedStack(bands, y, x, seed=0):
+    # A (bands, y, x) stack of 16 bit values, with a tenth of them masked
+    rng = np.random.RandomState(seed)
+    data = rng.randint(0, 1000, (bands, y, x)).astype(np.int16)
+    return np.ma.MaskedArray(data, rng.rand(bands, y, x) < 0.1)
+
+
+class StreamTest(unittest.TestCase):
+    def stream(self, reducers, data, blockSize=8):
+        blocks = (data[i:i+blockSize] for i in range(0, len(data), blockSize))
+        blocks, count = operations._streamBlocks(blocks, len(data), reducers)
+        return b''.join(Outputs.streamMsgPack(blocks, count))
+
+    def test_histogram_msgpack(self):
+        # A histogram per band, so the stream is an array of one row per band
+        data = maskedStack(20, 16, 16)
+        streamed = self.stream(['s_histogram'], data)
+        whole = Outputs.toMsgPack(operations.Reducers.apply(['s_histogram'], data))
+
+        unpacker = msgpack.Unpacker()
+        unpacker.feed(streamed)
+        objects = list(unpacker)
+        self.assertEqual(len(objects), 1)
+        self.assertEqual(len(objects[0]), 20)
+        self.assertEqual(streamed, whole)
+
+    def test_bandwise_msgpack(self):
+        data = maskedStack(20, 16, 16)
+        streamed = self.stream(['s_mean'], data)
+        whole = Outputs.toMsgPack(operations.Reducers.apply(['s_mean'], data))
+        self.assertEqual(streamed, whole)
+
+
+class DateRangeTest(unittest.TestCase):
+    # An asset of a band on the first of January of 2000 to 2005. Pixels rise
+    # by their column number each year from 2001 to 2004, and jump off that
+    # line in 2000 and 2005, so a trend over the wrong bands shows.
+    def setUp(self):
+        self.dataPath = Asset.DATA_PATH
+        Asset.DATA_PATH = tempfile.mkdtemp()
+        Asset.ASSET_POOL.clear()
+        
+        os.makedirs(os.path.join(Asset.DATA_PATH, 'trend'))
+        tif = os.path.join(Asset.DATA_PATH, 'trend', 'data.tif')
+        ds = gdal.GetDriverByName('GTiff').Create(tif, 4, 4, 6, gdal.GDT_Int16)
+        ds.SetGeoTransform((0, 10, 0, 40, 0, -10))
+        columns = np.tile(np.arange(4, dtype=np.int16), (4, 1))
+        for b, year in enumerate(range(2000, 2006)):
+            band = columns * (year - 2000) + 100
+            if year in (2000, 2005):
+                band = band + 500
+            ds.GetRasterBand(b+1).WriteArray(band)
+        gdal.GetDriverByName('VRT').CreateCopy(os.path.join(Asset.DATA_PATH, 'trend', 'default.vrt'), ds)
+        ds = None
+        
+        with open(os.path.join(Asset.DATA_PATH, 'trend', 'default.yaml'), 'w') as f:
+            f.write('band-dates:\n')
+            for b, year in enumerate(range(2000, 2006)):
+                f.write('  {}: {}-01-01\n'.format(b+1, year))
+
+    def tearDown(self):
+        shutil.rmtree(Asset.DATA_PATH)
+        Asset.DATA_PATH = self.dataPath
+        Asset.ASSET_POOL.clear()
+
+    def window(self, date, reducers):
+        (data,), kwargs = operations.op_window('trend', (0, 0, 40, 40), [4, 4], date,
+                                               output='py', reducers=reducers)
+        return data
+
+    def test_slope_over_range(self):
+        slope = self.window('2001-01-01..2004-12-31', ['t_slope'])
+        self.assertEqual(slope.shape, (1, 4, 4))
+        np.testing.assert_allclose(slope[0], np.tile(np.arange(4.0), (4, 1)), atol=1e-9)
+
+    def test_all_bands(self):
+        self.assertEqual(self.window('all', None).shape, (6, 4, 4))
+
+
+if __name__ == '__main__':
+    unittest.main()
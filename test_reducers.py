@@ -0,0 +1,35 @@
+import unittest
+import numpy as np
+import numpy.ma as npm
+
+import Reducers
+
+
+class PercentileTest(unittest.TestCase):
+    def test_equal_fractional_weights_median(self):
+        # Equal weights must give numpy's median, also where the cumulative
+        # weights round to just under half the total
+        for n in (6, 10, 22):
+            values = np.arange(1, n+1, dtype=np.float64).reshape((n, 1, 1))
+            A = npm.MaskedArray(values, np.zeros(values.shape, bool))
+            for w in (0.1, 0.2097, 0.3, 0.7):
+                median = Reducers._median(A, axis=0, weights=w)
+                self.assertEqual(float(median.ravel()[0]), np.median(values))
+
+    def test_sketch_equal_fractional_weights_median(self):
+        # The same, from exact (16 bit integer) histogram sketches
+        for n in (6, 10, 22):
+            values = np.arange(1, n+1, dtype=np.int16)
+            A = npm.MaskedArray(values, np.zeros(values.shape, bool))
+            for w in (0.1, 0.2097, 0.3, 0.7):
+                sketch = Reducers.Histogram.of(A, w)
+                self.assertTrue(sketch.exact)
+                self.assertEqual(sketch.percentile(50), np.median(values))
+
+    def test_percentile_range(self):
+        self.assertRaises(ValueError, Reducers.parse, 't_p150')
+        self.assertEqual(Reducers.parse('t_p100')[0].q, 100)
+
+
+if __name__ == '__main__':
+    unittest.main()
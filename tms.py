@@ -0,0 +1,72 @@
+import os
+import math
+
+if 'GDAL_DATA' not in os.environ:
+    os.environ['GDAL_DATA'] = r'/usr/lib/anaconda/share/gdal'
+from osgeo import osr
+
+# Well known text for Web Mercator projection used by Web Mapping libaries
+# Equivillent to EPSG:3857, but without the need to look it up on disk
+TMS_WKT = 'PROJCS["WGS 84 / Pseudo-Mercator",GEOGCS["WGS 84",DATUM["WGS_1984",SPHEROID["WGS 84",6378137,298.257223563,AUTHORITY["EPSG","7030"]],AUTHORITY["EPSG","6326"]],PRIMEM["Greenwich",0,AUTHORITY["EPSG","8901"]],UNIT["degree",0.0174532925199433,AUTHORITY["EPSG","9122"]],AUTHORITY["EPSG","4326"]],PROJECTION["Mercator_1SP"],PARAMETER["central_meridian",0],PARAMETER["scale_factor",1],PARAMETER["false_easting",0],PARAMETER["false_northing",0],UNIT["metre",1,AUTHORITY["EPSG","9001"]],AXIS["X",EAST],AXIS["Y",NORTH],EXTENSION["PROJ4","+proj=merc +a=6378137 +b=6378137 +lat_ts=0.0 +lon_0=0.0 +x_0=0.0 +y_0=0 +k=1.0 +units=m +nadgrids=@null +wktext +no_defs"],AUTHORITY["EPSG","3857"]]'
+TMS_SRS = osr.SpatialReference()
+TMS_SRS.ImportFromWkt(TMS_WKT)
+
+TILE_SIZE = 256
+
+#basis = 2 * math.pi * 6378137
+BASIS = 40075016.68557849
+
+
+def tileCommand(asset, date, zoom, x, y, compression='fast', output='png', reducers=None):
+    '''Returns the API call that renders the given tile as an image, of the
+    bands picked by date, or of them reduced, e.g. to a trend over a date range'''
+    return {'operation': 'window',
+            'asset': asset,
+            'window': tileBounds(x, y, zoom),
+            'date': date,
+            'srs': TMS_WKT,
+            'srs_type': 'WKT',
+            'window_size': [TILE_SIZE, TILE_SIZE],
+            'output': output,
+            'compression': compression,
+            'reducers': reducers
+            }
+
+
+def tileBounds(tx, ty, zoom):
+    '''Returns bounds of the given tile in EPSG:900913 coordinates'''
+
+    tx= float(tx); ty = float(ty); zoom=float(zoom)
+
+    z = 2**zoom;
+    ty = z-1-ty
+    minx = BASIS * (tx/z - 0.5)
+    miny = BASIS * (ty/z - 0.5)
+    maxx = BASIS * ((tx+1)/z - 0.5)
+    maxy = BASIS * ((ty+1)/z - 0.5)
+
+    return (minx, miny, maxx, maxy)
+
+
+def tileRange(bounds, zoom):
+    '''Returns the (xmin, ymin, xmax, ymax) tiles, inclusive, covering bounds
+    given in EPSG:900913 coordinates. The inverse of tileBounds().'''
+
+    z = 2**int(zoom)
+    minx, miny, maxx, maxy = bounds
+
+    def clip(t):
+        return min(max(int(math.floor(t)), 0), z-1)
+
+    return (clip(z * (minx/BASIS + 0.5)), clip(z * (0.5 - maxy/BASIS)),
+            clip(z * (maxx/BASIS + 0.5)), clip(z * (0.5 - miny/BASIS)))
+
+
+def boundsOverlap(a, b):
+    '''Whether bounds a and b, each (xmin, ymin, xmax, ymax), intersect'''
+    return a[0] < b[2] and b[0] < a[2] and a[1] < b[3] and b[1] < a[3]
+
+
+def googleTile(tx, ty, zoom):
+    '''Converts TMS tile coordinates to Google Tile coordinates'''
+    return (tx, 2**zoom - 1 - ty)